@@ -1,9 +1,21 @@
 """Games or Adversarial Search (Chapter 5)"""
 
+import concurrent.futures
 import copy
 import itertools
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import queue
 import random
+import struct
+import threading
+import time
+import types
 from collections import namedtuple
+from multiprocessing import shared_memory
 import pygame
 import sys
 
@@ -12,66 +24,64 @@ import numpy as np
 import games
 from utils import vector_add
 
-GameState = namedtuple('GameState', 'to_move, utility, board, moves')
+# key and images, the hash keys of the board and of its symmetric images, are
+# None where not given, for the game to work out from the board.
+GameState = namedtuple('GameState', 'to_move, utility, board, moves, key, images',
+                       defaults=(None, None))
 StochasticGameState = namedtuple('StochasticGameState', 'to_move, utility, board, moves, chance')
 
 
+class MutableState(types.SimpleNamespace):
+    """The fields of a state namedtuple as attributes that can be assigned
+    to, so that Game.make and Game.unmake can change the state in place."""
+
+
 # ______________________________________________________________________________
 # MinMax Search
 
 
-def minmax_decision(state, game):
+def minmax_decision(state, game, stats=None):
     """Given a state in a game, calculate the best move by searching
-    forward all the way to the terminal states. [Figure 5.3]"""
-
-    player = game.to_move(state)
-
-    def max_value(state):
-        if game.terminal_test(state):
-            return game.utility(state, player)
-        v = -np.inf
-        for a in game.actions(state):
-            v = max(v, min_value(game.result(state, a)))
-        return v
-
-    def min_value(state):
-        if game.terminal_test(state):
-            return game.utility(state, player)
-        v = np.inf
-        for a in game.actions(state):
-            v = min(v, max_value(game.result(state, a)))
-        return v
-
-    # Body of minmax_decision:
-    return max(game.actions(state), key=lambda a: min_value(game.result(state, a)))
+    forward all the way to the terminal states. [Figure 5.3]
+    The minimax values are found by principal_variation_search without
+    pruning. stats is an optional SearchStats."""
+    return principal_variation_search(state, game, d=np.inf, stats=stats, prune=False).move
 
 
 # ______________________________________________________________________________
 
 
-def expect_minmax(state, game):
+def expect_minmax(state, game, stats=None):
     """
     [Figure 5.11]
     Return the best move for a player after dice are thrown. The game tree
-	includes chance nodes along with min and max nodes.
+	includes chance nodes along with min and max nodes. stats is an
+	optional SearchStats.
 	"""
     player = game.to_move(state)
 
-    def max_value(state):
+    def max_value(state, depth):
+        if stats is not None:
+            stats.node(depth)
         v = -np.inf
         for a in game.actions(state):
-            v = max(v, chance_node(state, a))
+            v = max(v, chance_node(state, a, depth))
         return v
 
-    def min_value(state):
+    def min_value(state, depth):
+        if stats is not None:
+            stats.node(depth)
         v = np.inf
         for a in game.actions(state):
-            v = min(v, chance_node(state, a))
+            v = min(v, chance_node(state, a, depth))
         return v
 
-    def chance_node(state, action):
+    def chance_node(state, action, depth):
         res_state = game.result(state, action)
         if game.terminal_test(res_state):
+            if stats is not None:
+                stats.node(depth + 1)
+                stats.leaf()
             return game.utility(res_state, player)
         sum_chances = 0
         num_chances = len(game.chances(res_state))
@@ -79,99 +89,1219 @@ def expect_minmax(state, game):
             res_state = game.outcome(res_state, chance)
             util = 0
             if res_state.to_move == player:
-                util = max_value(res_state)
+                util = max_value(res_state, depth + 1)
             else:
-                util = min_value(res_state)
+                util = min_value(res_state, depth + 1)
             sum_chances += util * game.probability(chance)
         return sum_chances / num_chances
 
     # Body of expect_minmax:
-    return max(game.actions(state), key=lambda a: chance_node(state, a), default=None)
+    if stats is not None:
+        stats.start()
+    move = max(game.actions(state), key=lambda a: chance_node(state, a, 0), default=None)
+    if stats is not None:
+        stats.finish(None)
+    return move
 
 
-def alpha_beta_search(state, game):
+def alpha_beta_search(state, game, in_place=False, stats=None):
     """Search game to determine best action; use alpha-beta pruning.
-    As in [Figure 5.7], this version searches all the way to the leaves."""
+    As in [Figure 5.7], this version searches all the way to the leaves.
+    With in_place, the search plays moves on a single game.mutable copy of
+    state with game.make and game.unmake, instead of creating a new state
+    for every node with game.result. stats is an optional SearchStats."""
+    return principal_variation_search(state, game, d=np.inf, in_place=in_place, stats=stats).move
 
-    player = game.to_move(state)
 
-    # Functions used by alpha_beta
-    def max_value(state, alpha, beta):
-        if game.terminal_test(state):
-            return game.utility(state, player)
+def alpha_beta_cutoff_search(state, game, d=4, cutoff_test=None, eval_fn=None, tt=None,
+                             budget=None, ordering=None, batch_eval=None, in_place=False,
+                             quiescence=None, stats=None):
+    """Search game to determine best action; use alpha-beta pruning.
+    This version cuts off search and uses an evaluation function.
+    See principal_variation_search for the other arguments."""
+    return principal_variation_search(state, game, d, cutoff_test, eval_fn, tt, budget,
+                                      ordering, batch_eval, in_place,
+                                      quiescence=quiescence, stats=stats).move
+
+
+# ______________________________________________________________________________
+# Principal Variation Search
+
+
+# reused counts the nodes whose value was taken from an earlier search through
+# the transposition table, without knowing how deep that search went.
+SearchResult = namedtuple('SearchResult', 'move, score, pv, nodes, depth, reused', defaults=(0,))
+
+
+def child_value(game, state, move, value, in_place, *args):
+    """Return value(child, *args) for the child of state reached by move:
+    game.result(state, move), or with in_place, state itself between
+    game.make and game.unmake."""
+    if not in_place:
+        return value(game.result(state, move), *args)
+    undo = game.make(state, move)
+    v = value(state, *args)
+    game.unmake(state, undo)
+    return v
+
+
+def principal_variation_search(state, game, d=4, cutoff_test=None, eval_fn=None, tt=None,
+                               budget=None, ordering=None, batch_eval=None, in_place=False,
+                               guess=None, window=None, alpha=-np.inf, beta=np.inf,
+                               quiescence=None, stats=None, prune=True):
+    """Search game d plies deep with a negamax alpha-beta that searches every
+    move after the first with a null window; return a SearchResult (move,
+    score, pv, nodes, d). cutoff_test(state, depth) ends the search at a
+    node, scored by eval_fn(state) for the player to move at the root.
+    tt: TranspositionTable; ordering: MoveOrdering; budget: SearchBudget,
+    raising SearchTimeout once spent; batch_eval(children): the eval_fn
+    values of leaf children in one go (not with in_place); in_place: play
+    moves on game.mutable(state) with game.make and game.unmake; guess,
+    window: search the root within window of guess first; alpha, beta: the
+    root window; quiescence: nodes to search past each leaf along
+    game.forcing_moves; stats: SearchStats; prune: False searches every
+    move with the full window, as plain minimax does."""
+
+    if in_place and batch_eval is not None:
+        raise ValueError('batch_eval needs the states made by game.result, not in_place')
+    player = game.to_move(state)
+    # Stored values are from the point of view of the side to move at the
+    # node, and sides alternate with the ply from the root, so keep apart
+    # the entries of searches made for different players.
+    salt = random.Random(repr(player)).getrandbits(64)
+    if in_place:
+        state = game.mutable(state)
+    # The default test cuts off at depth d or at a terminal state
+    cutoff_test = (cutoff_test or (lambda state, depth: depth > d or game.terminal_test(state)))
+    heuristic = eval_fn is not None
+    eval_fn = eval_fn or (lambda state: game.utility(state, player))
+    nodes = reused = qnodes = 0
+    pv = {}  # The best line found from the node searched last at each depth
+
+    def probe(key, symmetry, alpha, beta, depth):
+        """Return (value or None, alpha, beta, hash_move) for a node."""
+        nonlocal reused
+        entry = tt.probe(key)
+        if entry is None:
+            return None, alpha, beta, None
+        # Moves are stored as played in the canonical position
+        move = entry.move
+        if move is not None:
+            move = game.map_move(move, symmetry, inverse=True)
+        if entry.depth >= d - depth:
+            if entry.flag == LOWER:
+                alpha = max(alpha, entry.value)
+            elif entry.flag == UPPER:
+                beta = min(beta, entry.value)
+            if entry.flag == EXACT or alpha >= beta:
+                if entry.age != tt.age and depth > 0:
+                    reused += 1
+                if stats is not None:
+                    stats.tt_hit()
+                return entry.value, alpha, beta, move
+        return None, alpha, beta, move
+
+    def record(key, symmetry, v, alpha, beta, depth, move):
+        flag = UPPER if v <= alpha else LOWER if v >= beta else EXACT
+        if move is not None:
+            move = game.map_move(move, symmetry)
+        tt.store(key, d - depth, flag, v, move)
+
+    def ordered(state, hash_move, depth):
+        actions = game.actions(state)
+        if ordering is not None:
+            return ordering.order(game.to_move(state), actions, depth, hash_move)
+        if hash_move is not None and hash_move in actions:
+            actions = [hash_move] + [a for a in actions if a != hash_move]
+        return actions
+
+    def frontier_values(state, actions, depth):
+        """Return the values of state's children if they are all leaves."""
+        children = []
+        for a in actions:
+            child = game.result(state, a)
+            if not cutoff_test(child, depth + 1):
+                return None
+            children.append(child)
+        if budget is not None:
+            for _ in children:
+                budget.tick()
+        if stats is not None:
+            stats.leaf(len(children))
+        return np.asarray(batch_eval(children)).tolist()
+
+    def quiesce(state, alpha, beta, color):
+        """Return the value of a leaf within (alpha, beta), searching its
+        forcing moves for as long as it is not quiet."""
+        nonlocal nodes, qnodes
+        if qnodes >= quiescence or game.terminal_test(state):
+            if stats is not None:
+                stats.leaf()
+            return color * eval_fn(state)
+        moves, quiet = game.forcing_moves(state)
+        # Only a quiet position may stand on its own evaluation
         v = -np.inf
-        for a in game.actions(state):
-            v = max(v, min_value(game.result(state, a), alpha, beta))
-            if v >= beta:
-                return v
+        if quiet:
+            if stats is not None:
+                stats.leaf()
+            v = color * eval_fn(state)
+        if v >= beta:
+            return v
+        alpha = max(alpha, v)
+        for a in moves:
+            nodes, qnodes = nodes + 1, qnodes + 1
+            if budget is not None:
+                budget.tick()
+            if stats is not None:
+                stats.node()
+            v = max(v, -child_value(game, state, a, quiesce, in_place, -beta, -alpha, -color))
+            if v >= beta or qnodes >= quiescence:
+                break
             alpha = max(alpha, v)
         return v
 
-    def min_value(state, alpha, beta):
-        if game.terminal_test(state):
-            return game.utility(state, player)
-        v = np.inf
-        for a in game.actions(state):
-            v = min(v, max_value(game.result(state, a), alpha, beta))
-            if v <= alpha:
-                return v
-            beta = min(beta, v)
+    def negamax(state, alpha, beta, depth, color):
+        """Return the value of state within (alpha, beta) for the side to
+        move at depth: player if color is 1, the opponent if it is -1."""
+        nonlocal nodes, qnodes
+        nodes += 1
+        if budget is not None:
+            budget.tick()
+        if stats is not None:
+            stats.node(depth)
+        pv[depth] = []
+        if cutoff_test(state, depth):
+            if quiescence:
+                qnodes = 0
+                return quiesce(state, alpha, beta, color)
+            if stats is not None:
+                stats.leaf()
+            return color * eval_fn(state)
+        hash_move = None
+        if tt is not None:
+            key, symmetry = game.search_key(state, heuristic)
+            key ^= salt
+            value, bounded_alpha, bounded_beta, hash_move = probe(key, symmetry, alpha, beta,
+                                                                  depth)
+            if depth > 0:  # The root is always searched, for its best move
+                if value is not None:
+                    return value
+                alpha, beta = bounded_alpha, bounded_beta
+        alpha0, best_move = alpha, None
+        actions = ordered(state, hash_move, depth)
+        values = batch_eval and not quiescence and actions and frontier_values(state, actions,
+                                                                              depth)
+        if values:
+            values = [color * value for value in values]
+            v = max(values)
+            best_move = actions[values.index(v)]
+            pv[depth] = [best_move]
+            if tt is not None:
+                record(key, symmetry, v, alpha0, beta, depth, best_move)
+            return v
+        v, ply = -np.inf, depth + 1
+        for i, a in enumerate(actions):
+            if i > 0 and prune:
+                # A null window only tells whether a beats the best move so far
+                null = math.nextafter(alpha, np.inf)
+                score = -child_value(game, state, a, negamax, in_place, -null, -alpha, ply, -color)
+            if i == 0 or not prune or alpha < score < beta:
+                score = -child_value(game, state, a, negamax, in_place, -beta, -alpha, ply, -color)
+            if score > v:
+                v, best_move = score, a
+                if v > alpha:
+                    pv[depth] = [a] + pv[depth + 1]
+            if v >= beta:
+                if ordering is not None:
+                    ordering.cutoff(game.to_move(state), a, depth, i, d - depth + 1)
+                if stats is not None:
+                    stats.cutoff(i)
+                break
+            if prune:
+                alpha = max(alpha, v)
+        if tt is not None:
+            record(key, symmetry, v, alpha0, beta, depth, best_move)
         return v
 
-    # Body of alpha_beta_search:
-    best_score = -np.inf
-    beta = np.inf
+    # Body of principal_variation_search starts here:
+    if tt is not None:
+        tt.new_search()
+    if stats is not None:
+        stats.start()
+    try:
+        if guess is not None and window is not None:
+            alpha, beta = guess - window, guess + window
+            score = negamax(state, alpha, beta, 0, 1)
+            if score <= alpha:
+                score = negamax(state, -np.inf, beta, 0, 1)
+            elif score >= beta:
+                score = negamax(state, alpha, np.inf, 0, 1)
+        else:
+            score = negamax(state, alpha, beta, 0, 1)
+    finally:
+        if stats is not None:
+            stats.finish(d)
+    line = pv[0]
+    return SearchResult(move=line[0] if line else None, score=score, pv=line, nodes=nodes, depth=d,
+                        reused=reused)
+
+
+def mtdf_search(state, game, d=4, cutoff_test=None, eval_fn=None, tt=None, budget=None,
+                ordering=None, batch_eval=None, in_place=False, guess=0, quiescence=None,
+                stats=None):
+    """Search game d plies deep with MTD(f), a series of null-window
+    principal_variation_search passes sharing tt that close in on the score
+    from guess, and return a SearchResult. The other arguments are those of
+    principal_variation_search."""
+    tt = tt if tt is not None else TranspositionTable()
+    score, lower, upper = guess, -np.inf, np.inf
+    move, line, nodes, reused = None, [], 0, None
+    while lower < upper:
+        # Test whether the score is above the largest value it may not exceed
+        test = score if score > lower else math.nextafter(lower, np.inf)
+        result = principal_variation_search(state, game, d, cutoff_test, eval_fn, tt, budget,
+                                            ordering, batch_eval, in_place,
+                                            alpha=math.nextafter(test, -np.inf), beta=test,
+                                            quiescence=quiescence, stats=stats)
+        score, nodes = result.score, nodes + result.nodes
+        if reused is None:  # Later passes reuse the earlier ones on purpose
+            reused = result.reused
+        if score < test:
+            upper = score
+        else:
+            lower = score
+            move, line = result.move, result.pv
+    return SearchResult(move=move, score=score, pv=line, nodes=nodes, depth=d, reused=reused or 0)
+
+
+class SearchTimeout(Exception):
+    """Raised inside a search whose SearchBudget has run out."""
+
+
+class SearchBudget:
+    """Limits a search to time_limit seconds and/or node_limit nodes."""
+
+    def __init__(self, time_limit=None, node_limit=None):
+        self.deadline = None if time_limit is None else time.perf_counter() + time_limit
+        self.node_limit = node_limit
+        self.nodes = 0
+        self.stopped = False
+        self.parts = []
+
+    def stop(self):
+        """Spend the budget at once; safe to call from another thread."""
+        self.stopped = True
+        for part in self.parts:
+            part.stop()
+
+    def part(self, fraction):
+        """Return a SearchBudget for fraction of the time and nodes left of
+        this one, which stop() stops as well."""
+        time_limit = node_limit = None
+        if self.deadline is not None:
+            time_limit = fraction * max(self.deadline - time.perf_counter(), 0)
+        if self.node_limit is not None:
+            node_limit = int(fraction * max(self.node_limit - self.nodes, 0))
+        part = SearchBudget(time_limit, node_limit)
+        self.parts.append(part)
+        part.stopped = self.stopped
+        return part
+
+    def tick(self):
+        """Count one node, raising SearchTimeout if the budget is spent."""
+        self.nodes += 1
+        if self.stopped:
+            raise SearchTimeout
+        if self.node_limit is not None and self.nodes > self.node_limit:
+            raise SearchTimeout
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise SearchTimeout
+
+
+class SearchStats:
+    """Counts the nodes, leaves, cutoffs by move index (cutoffs[i]), table
+    hits, deepest ply and per-iteration depth, nodes and seconds of the
+    searches it is passed to; as_dict() and to_json() export them."""
+
+    def __init__(self):
+        self.nodes = 0
+        self.leaves = 0
+        self.cutoffs = {}
+        self.tt_hits = 0
+        self.max_depth = 0
+        self.iterations = []
+        self.started = None
+        self.base = 0
+
+    def node(self, depth=0):
+        self.nodes += 1
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def leaf(self, count=1):
+        self.leaves += count
+
+    def cutoff(self, index):
+        self.cutoffs[index] = self.cutoffs.get(index, 0) + 1
+
+    def tt_hit(self):
+        self.tt_hits += 1
+
+    def start(self):
+        self.started, self.base = time.perf_counter(), self.nodes
+
+    def finish(self, depth):
+        """End the iteration begun by start(), which searched depth plies
+        (None, or infinite, for a search to the end of the game)."""
+        seconds = time.perf_counter() - self.started
+        depth = None if depth is None or depth == np.inf else int(depth)
+        self.iterations.append({'depth': depth, 'nodes': self.nodes - self.base,
+                                'seconds': seconds})
+
+    @property
+    def seconds(self):
+        return sum(iteration['seconds'] for iteration in self.iterations)
+
+    @property
+    def branching_factor(self):
+        """The effective branching factor: how many times more nodes every
+        further ply of depth costs. It is measured between the first and
+        last iterations of different depths if there are any, and else
+        taken as the max_depth-th root of the nodes."""
+        deep = [i for i in self.iterations if i['depth'] is not None and i['nodes']]
+        if len(deep) > 1 and deep[-1]['depth'] > deep[0]['depth']:
+            first, last = deep[0], deep[-1]
+            return (last['nodes'] / first['nodes']) ** (1 / (last['depth'] - first['depth']))
+        if self.max_depth == 0:
+            return float(self.nodes > 1)
+        return self.nodes ** (1 / self.max_depth)
+
+    def as_dict(self):
+        seconds = self.seconds
+        return {'nodes': self.nodes, 'leaves': self.leaves,
+                'cutoffs': {str(i): n for i, n in sorted(self.cutoffs.items())},
+                'tt_hits': self.tt_hits, 'max_depth': self.max_depth,
+                'branching_factor': self.branching_factor, 'seconds': seconds,
+                'nodes_per_second': self.nodes / seconds if seconds else None,
+                'iterations': self.iterations}
+
+    def to_json(self, **kwargs):
+        """Return the statistics as a JSON string; kwargs go to json.dumps."""
+        return json.dumps(self.as_dict(), **kwargs)
+
+
+def iterative_deepening_search(state, game, time_limit=None, node_limit=None, max_depth=None,
+                               eval_fn=None, tt=None, ordering=None, budget=None,
+                               on_iteration=None, batch_eval=None, in_place=False, aspiration=None,
+                               mtdf=False, quiescence=None, stats=None):
+    """Run principal_variation_search with d = 0, 1, 2, ... until time_limit
+    seconds or node_limit nodes are used up, or max_depth is done, and
+    return the best move of the deepest search that finished. budget: a
+    SearchBudget instead of the limits; on_iteration(d, move): called after
+    every iteration; aspiration: window around the previous score; mtdf:
+    search every depth with mtdf_search. The other arguments are passed on."""
+    if budget is None and time_limit is None and node_limit is None and max_depth is None:
+        raise ValueError('iterative deepening needs a time_limit, node_limit or max_depth')
+    tt = tt if tt is not None else TranspositionTable()
+    ordering = ordering if ordering is not None else MoveOrdering()
+    budget = budget if budget is not None else SearchBudget(time_limit, node_limit)
     best_action = None
-    for a in game.actions(state):
-        v = min_value(game.result(state, a), best_score, beta)
-        if v > best_score:
-            best_score = v
-            best_action = a
+    scores = []
+    d = 0
+    horizon = False
+
+    def cutoff_test(state, depth):
+        nonlocal horizon
+        if game.terminal_test(state):
+            return True
+        if depth > d:
+            horizon = True
+            return True
+        return False
+
+    while max_depth is None or d <= max_depth:
+        horizon = False
+        try:
+            if mtdf:
+                guess = scores[-2] if len(scores) > 1 else scores[-1] if scores else 0
+                result = mtdf_search(state, game, d, cutoff_test, eval_fn, tt, budget, ordering,
+                                     batch_eval, in_place, guess, quiescence, stats)
+            else:
+                guess = scores[-1] if scores else None
+                result = principal_variation_search(state, game, d, cutoff_test, eval_fn, tt,
+                                                    budget, ordering, batch_eval, in_place, guess,
+                                                    aspiration, quiescence=quiescence,
+                                                    stats=stats)
+        except SearchTimeout:
+            break
+        best_action = result.move
+        scores.append(result.score)
+        if on_iteration is not None:
+            on_iteration(d, best_action)
+        if not horizon and not result.reused:
+            break  # The whole game tree fits within this depth
+        d += 1
+    if best_action is None and game.actions(state):
+        best_action = game.actions(state)[0]
     return best_action
 
 
-def alpha_beta_cutoff_search(state, game, d=4, cutoff_test=None, eval_fn=None):
-    """Search game to determine best action; use alpha-beta pruning.
-    This version cuts off search and uses an evaluation function."""
+# ______________________________________________________________________________
+# Parallel Search
+
+
+# The best root score found so far and the transposition tables of the
+# current search, in each worker process of a ParallelSearch.
+root_bound = None
+worker_tables = {}
+
+
+def init_root_worker(bound):
+    global root_bound
+    root_bound = bound
+
+
+def root_move_value(game, state, move, d, eval_fn_for, alpha, tt=None, budget=None):
+    """Search the child of state reached by move as principal_variation_search
+    would at depth 1 of a search d deep, and return (its value for the
+    player to move in state, the child's SearchResult). A value <= alpha is
+    only an upper bound on the true value. eval_fn_for(player) returns an
+    eval_fn scoring states for player; by default the game's utility."""
+    child = game.result(state, move)
+    eval_fn = eval_fn_for(game.to_move(child)) if eval_fn_for is not None else None
+    result = principal_variation_search(child, game, d - 1, eval_fn=eval_fn, tt=tt, budget=budget,
+                                        ordering=MoveOrdering(), beta=-alpha)
+    return -result.score, result
+
+
+def root_move_task(search, game, state, move, d, eval_fn_for, deadline):
+    """root_move_value for a worker process, searched with a window opened
+    just below the best root score found so far, which it then raises if
+    move does better. Return (value, alpha, SearchResult)."""
+    if search not in worker_tables:
+        worker_tables.clear()
+        worker_tables[search] = TranspositionTable()
+    # Just below, so that a move as good as the best so far shows it
+    alpha = math.nextafter(root_bound.value, -np.inf)
+    budget = SearchBudget(deadline - time.time()) if deadline is not None else None
+    value, result = root_move_value(game, state, move, d, eval_fn_for, alpha,
+                                    worker_tables[search], budget)
+    with root_bound.get_lock():
+        root_bound.value = max(root_bound.value, value)
+    return value, alpha, result
+
+
+class ParallelSearch:
+    """Splits the root moves of a search between worker processes, Young
+    Brothers Wait style: the first move alone, then the others in parallel.
+    The game, states and eval_fn_for must pickle."""
+
+    def __init__(self, workers=None):
+        self.bound = multiprocessing.Value('d', -np.inf)
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=init_root_worker, initargs=(self.bound,))
+        self.tt = TranspositionTable()
+        self.searches = 0
+
+    def search(self, state, game, d=4, eval_fn_for=None, time_limit=None):
+        """Search state d plies deep and return a SearchResult, as
+        principal_variation_search(state, game, d, eval_fn=eval_fn_for(player))
+        would. SearchTimeout is raised if time_limit seconds run out."""
+        player = game.to_move(state)
+        if game.terminal_test(state) or d < 0:
+            eval_fn = eval_fn_for(player) if eval_fn_for is not None else None
+            return principal_variation_search(state, game, d, eval_fn=eval_fn)
+        self.searches += 1
+        deadline = time.time() + time_limit if time_limit is not None else None
+        budget = SearchBudget(time_limit) if time_limit is not None else None
+        actions = game.actions(state)
+        self.tt.clear()
+        value, result = root_move_value(game, state, actions[0], d, eval_fn_for, -np.inf,
+                                        self.tt, budget)
+        results = [(value, result)]
+        self.bound.value = value
+        futures = [self.executor.submit(root_move_task, self.searches, game, state, a, d,
+                                        eval_fn_for, deadline) for a in actions[1:]]
+        try:
+            for future in futures:
+                value, alpha, result = future.result()
+                # A move that failed low is worse than an earlier one
+                results.append((value if value > alpha else -np.inf, result))
+        finally:
+            for future in futures:
+                future.cancel()
+        values = [value for value, result in results]
+        i = values.index(max(values))
+        value, result = results[i]
+        return SearchResult(move=actions[i], score=value, pv=[actions[i]] + result.pv,
+                            nodes=1 + sum(result.nodes for value, result in results), depth=d,
+                            reused=sum(result.reused for value, result in results))
+
+    def close(self):
+        """Shut the worker processes down."""
+        self.executor.shutdown(cancel_futures=True)
+
+
+LazySMPResult = namedtuple('LazySMPResult', 'move, depth, nodes')
+
+
+def lazy_smp_worker(worker, tt, game, state, deadline, node_limit, max_depth, eval_fn_for):
+    """Run one worker of a LazySMP search and return its (depth, move, nodes):
+    the depth of its last finished iteration and the move it found, and the
+    number of nodes it searched."""
+    depth = -1
+
+    def on_iteration(d, move):
+        nonlocal depth
+        depth = d
+
+    time_limit = max(deadline - time.time(), 0) if deadline is not None else None
+    budget = SearchBudget(time_limit, node_limit)
+    eval_fn = eval_fn_for(game.to_move(state)) if eval_fn_for is not None else None
+    try:
+        move = iterative_deepening_search(state, game, max_depth=max_depth, eval_fn=eval_fn, tt=tt,
+                                          ordering=MoveOrdering(seed=worker or None),
+                                          budget=budget, on_iteration=on_iteration)
+    finally:
+        tt.close()
+    return depth, move, budget.nodes
+
+
+class LazySMP:
+    """Lazy SMP: worker processes all run iterative_deepening_search on the
+    same position, sharing a SharedTranspositionTable. search returns a
+    LazySMPResult (move, depth, nodes of each worker). moves: every move of
+    the game, for the table. The game, states and eval_fn_for must pickle."""
+
+    def __init__(self, moves, workers=4, tt_size=2 ** 20):
+        self.workers = workers
+        self.tt = SharedTranspositionTable(tt_size, moves)
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+
+    def search(self, state, game, time_limit=None, node_limit=None, max_depth=None,
+               eval_fn_for=None):
+        """Search state until time_limit seconds pass or every worker has
+        used node_limit nodes or finished max_depth. eval_fn_for(player)
+        returns an eval_fn scoring states for player."""
+        if time_limit is None and node_limit is None and max_depth is None:
+            raise ValueError('Lazy SMP needs a time_limit, node_limit or max_depth')
+        self.tt.clear()
+        deadline = time.time() + time_limit if time_limit is not None else None
+        futures = [self.executor.submit(lazy_smp_worker, worker, self.tt, game, state, deadline,
+                                        node_limit, max_depth, eval_fn_for)
+                   for worker in range(self.workers)]
+        results = [future.result() for future in futures]
+        depth = max(depth for depth, move, nodes in results)
+        move = next(move for d, move, nodes in results if d == depth)
+        return LazySMPResult(move=move, depth=depth,
+                             nodes=[nodes for depth, move, nodes in results])
+
+    def close(self):
+        """Shut the worker processes down and free the shared table."""
+        self.executor.shutdown(cancel_futures=True)
+        self.tt.close()
+        self.tt.memory.unlink()
+
+
+# ______________________________________________________________________________
+# Monte Carlo Tree Search
+
+
+def sample_outcome(game, state, rng):
+    """Roll the dice of a StochasticGame state that still needs them, with
+    the probability of every chance; other states are returned as is."""
+    if isinstance(game, StochasticGame) and state.chance is None:
+        chances = game.chances(state)
+        weights = [game.probability(chance) for chance in chances]
+        state = game.outcome(state, rng.choices(chances, weights)[0])
+    return state
+
 
+def random_playout(game, state, rng):
+    """Play random moves from state to the end of the game, and return the
+    utility of the final state to the player to move in state."""
     player = game.to_move(state)
+    while not game.terminal_test(state):
+        state = sample_outcome(game, state, rng)
+        actions = game.actions(state)
+        if not actions:
+            break
+        state = game.result(state, rng.choice(actions))
+    return game.utility(state, player)
+
+
+class MCTSNode:
+    """A node of a Monte Carlo search tree, reached by move made by player.
+    visits counts the playouts through the node and reward sums their
+    utility to player. state is the state of the node, except in a
+    StochasticGame, where the same moves may lead to different states."""
+
+    def __init__(self, move=None, player=None, state=None):
+        self.move = move
+        self.player = player
+        self.state = state
+        self.children = {}
+        self.visits = 0
+        self.reward = 0
+
+
+class MCTS:
+    """A Monte Carlo tree search player, with UCT selection and playouts by
+    playout(state, rng) (default random_playout). A search runs for
+    time_limit seconds and/or iterations iterations and plays the most
+    visited move; the tree is kept between moves."""
+
+    def __init__(self, game, time_limit=None, iterations=None, exploration=math.sqrt(2),
+                 playout=None, seed=None):
+        if time_limit is None and iterations is None:
+            raise ValueError('MCTS needs a time_limit or a number of iterations')
+        self.game = game
+        self.time_limit = time_limit
+        self.iterations = iterations
+        self.exploration = exploration
+        self.playout = playout or (lambda state, rng: random_playout(game, state, rng))
+        self.rng = random.Random(seed)
+        self.stochastic = isinstance(game, StochasticGame)
+        self.root = None
+        self.playouts = 0
+
+    def __call__(self, game, state):
+        return self.search(state)
+
+    def search(self, state):
+        """Search state and return the move played most often from it."""
+        self.root = self.find_root(state)
+        deadline = time.perf_counter() + self.time_limit if self.time_limit is not None else None
+        self.playouts = 0
+        while ((self.iterations is None or self.playouts < self.iterations) and
+               (deadline is None or time.perf_counter() < deadline)):
+            self.iterate(state)
+            self.playouts += 1
+        actions = self.game.actions(state)
+        children = [self.root.children[a] for a in actions if a in self.root.children]
+        if not children:
+            return actions[0] if actions else None
+        return max(children, key=lambda child: child.visits).move
+
+    def find_root(self, state):
+        """Return the node of the last tree for state, or a new root."""
+        root = self.root
+        if root is not None and not self.stochastic:
+            nodes = [root] + list(root.children.values())
+            nodes += [node for child in root.children.values() for node in child.children.values()]
+            for node in nodes:
+                if node.state == state:
+                    return node
+        return MCTSNode(state=state)
+
+    def iterate(self, state):
+        """Run one selection, expansion, playout and backpropagation."""
+        game, rng = self.game, self.rng
+        node, path = self.root, [self.root]
+        while not game.terminal_test(state):
+            state = sample_outcome(game, state, rng)
+            actions = game.actions(state)
+            if not actions:
+                break
+            untried = [a for a in actions if a not in node.children]
+            player = game.to_move(state)
+            if untried:
+                move = rng.choice(untried)
+                state = game.result(state, move)
+                node.children[move] = MCTSNode(move, player, None if self.stochastic else state)
+                path.append(node.children[move])
+                break
+            log_visits = math.log(node.visits)
+
+            def uct(child):
+                return (child.reward / child.visits +
+                        self.exploration * math.sqrt(log_visits / child.visits))
+
+            node = max((node.children[a] for a in actions), key=uct)
+            state = node.state if not self.stochastic else game.result(state, node.move)
+            path.append(node)
+        utility, player = self.playout(state, rng), game.to_move(state)
+        for node in path:
+            node.visits += 1
+            node.reward += utility if node.player == player else -utility
+
+
+def mcts_worker(game, state, seed, time_limit, iterations, exploration, playout):
+    """Search state with a fresh MCTS tree, and return {move: visits} for its
+    root, for RootParallelMCTS."""
+    mcts = MCTS(game, time_limit, iterations, exploration, playout, seed)
+    mcts.search(state)
+    return {move: child.visits for move, child in mcts.root.children.items()}
+
+
+class RootParallelMCTS:
+    """MCTS in worker processes, each growing its own tree from the same
+    position with a different seed; the root visits of all trees choose the
+    move. The game and playout must pickle."""
+
+    def __init__(self, game, workers=None, time_limit=None, iterations=None,
+                 exploration=math.sqrt(2), playout=None, seed=None):
+        if time_limit is None and iterations is None:
+            raise ValueError('MCTS needs a time_limit or a number of iterations')
+        self.game = game
+        self.workers = workers or os.cpu_count()
+        self.time_limit = time_limit
+        self.iterations = iterations
+        self.exploration = exploration
+        self.playout = playout
+        self.rng = random.Random(seed)
+        self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+
+    def __call__(self, game, state):
+        return self.search(state)
+
+    def search(self, state):
+        """Search state and return the move played most often from it."""
+        futures = [self.executor.submit(mcts_worker, self.game, state, self.rng.getrandbits(64),
+                                        self.time_limit, self.iterations, self.exploration,
+                                        self.playout)
+                   for worker in range(self.workers)]
+        visits = {}
+        for future in futures:
+            for move, n in future.result().items():
+                visits[move] = visits.get(move, 0) + n
+        actions = self.game.actions(state)
+        return max(actions, key=lambda a: visits.get(a, 0)) if actions else None
+
+    def close(self):
+        """Shut the worker processes down."""
+        self.executor.shutdown(cancel_futures=True)
 
-    # Functions used by alpha_beta
-    def max_value(state, alpha, beta, depth):
-        if cutoff_test(state, depth):
-            return eval_fn(state)
-        v = -np.inf
-        for a in game.actions(state):
-            v = max(v, min_value(game.result(state, a), alpha, beta, depth + 1))
-            if v >= beta:
-                return v
-            alpha = max(alpha, v)
-        return v
 
-    def min_value(state, alpha, beta, depth):
-        if cutoff_test(state, depth):
-            return eval_fn(state)
-        v = np.inf
-        for a in game.actions(state):
-            v = min(v, max_value(game.result(state, a), alpha, beta, depth + 1))
-            if v <= alpha:
-                return v
-            beta = min(beta, v)
-        return v
+# ______________________________________________________________________________
+# Background Analysis
+
+
+Analysis = namedtuple('Analysis', 'state, depth, move, done')
+
+
+class AnalysisService:
+    """Searches positions on a background thread: submit() hands over a
+    position, poll() returns its latest Analysis or None, cancel() abandons
+    it. player: submit(state, player) publishes player(game, state)
+    instead; ponder: go on searching the replies; book(state, budget): a
+    move to play without searching, or None. The other arguments are those
+    of iterative_deepening_search."""
+
+    def __init__(self, game, time_limit=None, node_limit=None, max_depth=None,
+                 eval_fn_for=None, ponder=False, book=None, quiescence=None, aspiration=None):
+        self.game = game
+        self.limits = (time_limit, node_limit)
+        self.max_depth = max_depth
+        # eval_fn_for(player) gives the evaluation function of a search
+        # for player; None means the game's utility.
+        self.eval_fn_for = eval_fn_for
+        self.ponder = ponder
+        self.book = book
+        self.quiescence = quiescence
+        self.aspiration = aspiration
+        self.tt = TranspositionTable(2 ** 18)
+        self.ordering = MoveOrdering()
+        self.finished = {}
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.job = 0
+        # The job whose results are being published, the key of the
+        # position being searched and the budget of that search.
+        self.target = self.searching = self.budget = None
+        self.latest = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, state, player=None):
+        """Start analysing state, abandoning whatever came before."""
+        key = self.game.hash_key(state)
+        with self.lock:
+            self.job += 1
+            self.latest = self.recall(state) if player is None else None
+            if self.latest is not None:
+                self.stop()
+            elif player is None and key == self.searching:
+                self.target = self.job
+            else:
+                self.stop()
+            if self.latest is None or self.ponder:
+                self.jobs.put((self.job, state, player))
+
+    def poll(self):
+        """Return the latest Analysis of the submitted position, or None."""
+        return self.latest
+
+    def cancel(self):
+        """Abandon the submitted position."""
+        with self.lock:
+            self.job += 1
+            self.latest = None
+            self.stop()
+
+    def close(self):
+        """Cancel any search and end the background thread."""
+        self.cancel()
+        self.jobs.put((None, None, None))
+        self.thread.join()
+
+    def stop(self):
+        if self.budget is not None:
+            self.budget.stop()
+
+    def recall(self, state):
+        """Return the finished Analysis of state, or of a position sharing
+        its search_key, or None."""
+        key, symmetry = self.game.search_key(state, self.eval_fn_for is not None)
+        analysis = self.finished.get(key)
+        if analysis is None:
+            return None
+        move = self.game.map_move(analysis.move, symmetry, inverse=True)
+        return analysis._replace(state=state, move=move)
+
+    def publish(self, analysis):
+        with self.lock:
+            if self.target == self.job:
+                self.latest = analysis
+
+    def search(self, job, state, target):
+        """Search state for job, publishing to job target (None while
+        pondering); return the Analysis, or None if it was abandoned."""
+        key = self.game.hash_key(state)
+        with self.lock:
+            if job != self.job:
+                return None
+            self.budget = budget = SearchBudget(*self.limits)
+            self.searching, self.target = key, target
+        eval_fn = self.eval_fn_for and self.eval_fn_for(self.game.to_move(state))
+        depth = None
+
+        def on_iteration(d, move):
+            nonlocal depth
+            depth = d
+            self.publish(Analysis(state, d, move, False))
+
+        move = self.book(state, budget) if self.book is not None else None
+        if move is None:
+            move = iterative_deepening_search(state, self.game, max_depth=self.max_depth,
+                                              eval_fn=eval_fn, tt=self.tt, ordering=self.ordering,
+                                              budget=budget, on_iteration=on_iteration,
+                                              quiescence=self.quiescence,
+                                              aspiration=self.aspiration)
+        with self.lock:
+            self.budget = self.searching = None
+            if budget.stopped:
+                return None
+            analysis = Analysis(state, depth, move, True)
+            cache_key, symmetry = self.game.search_key(state, self.eval_fn_for is not None)
+            self.finished[cache_key] = analysis._replace(move=self.game.map_move(move, symmetry))
+            if self.target == self.job:
+                self.latest = analysis
+        return analysis
+
+    def run(self):
+        game = self.game
+        while True:
+            job, state, player = self.jobs.get()
+            if job is None:
+                return
+            if player is not None:
+                with self.lock:
+                    if job != self.job:
+                        continue
+                    self.target = job
+                self.publish(Analysis(state, None, player(game, state), True))
+                continue
+            analysis = self.recall(state) or self.search(job, state, job)
+            if analysis is None or not self.ponder:
+                continue
+            replies = [analysis.move] + [a for a in game.actions(state) if a != analysis.move]
+            for move in replies:
+                child = game.result(state, move)
+                if game.terminal_test(child) or self.recall(child) is not None:
+                    continue
+                self.search(job, child, None)
+                if job != self.job:
+                    break  # The opponent has moved
 
-    # Body of alpha_beta_cutoff_search starts here:
-    # The default test cuts off at depth d or at a terminal state
-    cutoff_test = (cutoff_test or (lambda state, depth: depth > d or game.terminal_test(state)))
-    eval_fn = eval_fn or (lambda state: game.utility(state, player))
-    best_score = -np.inf
-    beta = np.inf
-    best_action = None
-    for a in game.actions(state):
-        v = min_value(game.result(state, a), best_score, beta, 1)
-        if v > best_score:
-            best_score = v
-            best_action = a
-    return best_action
+
+# ______________________________________________________________________________
+# Move Ordering
+
+
+class MoveOrdering:
+    """Orders the moves of a node: the hash move, then killer moves, then
+    the rest by history score; ties are shuffled if a seed is given."""
+
+    def __init__(self, killers=2, seed=None):
+        self.killer_slots = killers
+        self.killers = {}
+        self.history = {}
+        self.cutoffs = self.first_move_cutoffs = 0
+        # With a seed, ties are broken in a random order instead
+        self.rng = random.Random(seed) if seed is not None else None
+
+    def order(self, player, actions, ply, hash_move=None):
+        """Return the moves in actions in the order they should be tried."""
+        killers = self.killers.get(ply, ())
+        history = self.history
+        if self.rng is not None:
+            actions = self.rng.sample(actions, len(actions))
+
+        def priority(move):
+            if move == hash_move:
+                return np.inf
+            score = history.get((player, move), 0)
+            return score + 1e9 if move in killers else score
+
+        return sorted(actions, key=priority, reverse=True)
+
+    def cutoff(self, player, move, ply, index, depth):
+        """Record that move, tried index-th at ply, cut off a search depth
+        plies deep."""
+        self.cutoffs += 1
+        if index == 0:
+            self.first_move_cutoffs += 1
+        killers = self.killers.setdefault(ply, [])
+        if move not in killers:
+            killers.insert(0, move)
+            del killers[self.killer_slots:]
+        self.history[player, move] = self.history.get((player, move), 0) + depth * depth
+
+    @property
+    def first_move_cutoff_rate(self):
+        """The fraction of cutoffs caused by the first move tried."""
+        return self.first_move_cutoffs / self.cutoffs if self.cutoffs else 0.0
+
+
+# ______________________________________________________________________________
+# Transposition Tables
+
+
+# Bound types of a stored value: the exact value, or only a lower or upper bound.
+EXACT, LOWER, UPPER = 'EXACT', 'LOWER', 'UPPER'
+
+TTEntry = namedtuple('TTEntry', 'key, depth, flag, value, move, age')
+
+
+def zobrist_keys(items, seed=0):
+    """Return a dict giving each item a random 64-bit key. The hash of a
+    position is the XOR of the keys of its (square, player) items, so it can
+    be updated incrementally whenever a piece is placed or removed."""
+    rng = random.Random(seed)
+    return {item: rng.getrandbits(64) for item in items}
+
+
+class TranspositionTable:
+    """A fixed-size table of search results indexed by position hash keys.
+    replace decides which of two entries for the same slot is kept:
+    'always' the newest, 'depth' the deeper one unless it is from an
+    earlier search (see new_search)."""
+
+    def __init__(self, size=2 ** 16, replace='depth'):
+        if replace not in ('always', 'depth'):
+            raise ValueError('unknown replacement policy: {}'.format(replace))
+        self.size = 1 << max(size - 1, 1).bit_length()
+        self.mask = self.size - 1
+        self.replace = replace
+        self.slots = [None] * self.size
+        self.age = 0
+        self.hits = self.misses = self.stores = 0
+
+    def probe(self, key):
+        """Return the entry stored for key, or None."""
+        entry = self.slots[key & self.mask]
+        if entry is not None and entry.key == key:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def store(self, key, depth, flag, value, move):
+        """Remember the result of searching key's position depth plies deep."""
+        index = key & self.mask
+        old = self.slots[index]
+        if (old is None or self.replace == 'always' or old.key == key or
+                old.age != self.age or depth >= old.depth):
+            self.slots[index] = TTEntry(key, depth, flag, value, move, self.age)
+            self.stores += 1
+
+    def new_search(self):
+        """Mark the entries stored so far as belonging to an earlier search."""
+        self.age += 1
+
+    def clear(self):
+        self.slots = [None] * self.size
+        self.age = 0
+        self.hits = self.misses = self.stores = 0
+
+    def __len__(self):
+        return self.size - self.slots.count(None)
+
+
+class SharedTranspositionTable:
+    """A TranspositionTable in shared memory that several processes read
+    and write without locks. moves: every move of the game; storing any
+    other move raises KeyError. The creating process must unlink it when
+    done; a pickled table attaches by name."""
+
+    def __init__(self, size=2 ** 16, moves=(), name=None):
+        self.size = 1 << max(size - 1, 1).bit_length()
+        self.mask = self.size - 1
+        self.moves = list(moves)
+        self.move_numbers = {move: number for number, move in enumerate(self.moves, 1)}
+        self.memory = shared_memory.SharedMemory(name, create=name is None, size=self.size * 24)
+        self.words = self.memory.buf.cast('Q')
+        self.age = (os.getpid() & 0x3FF) << 16
+        self.hits = self.misses = self.stores = 0
+        if name is None:
+            self.clear()
+
+    def __reduce__(self):
+        return SharedTranspositionTable, (self.size, self.moves, self.memory.name)
+
+    def probe(self, key):
+        """Return the entry stored for key, or None."""
+        key &= 0xFFFFFFFFFFFFFFFF
+        i = 3 * (key & self.mask)
+        check, data, bits = self.words[i], self.words[i + 1], self.words[i + 2]
+        if data and check ^ data ^ bits == key:
+            self.hits += 1
+            value, = struct.unpack('<d', struct.pack('<Q', bits))
+            number = data >> 18 & 0xFFFFF
+            flag = (EXACT, LOWER, UPPER)[(data >> 16 & 3) - 1]
+            value = int(value) if value.is_integer() else value
+            return TTEntry(key, self.unpack_depth(data), flag, value,
+                           self.moves[number - 1] if number else None, data >> 38)
+        self.misses += 1
+        return None
+
+    def store(self, key, depth, flag, value, move):
+        """Remember the result of searching key's position depth plies deep."""
+        key &= 0xFFFFFFFFFFFFFFFF
+        i = 3 * (key & self.mask)
+        check, old = self.words[i], self.words[i + 1]
+        if (old and check ^ old ^ self.words[i + 2] != key and old >> 38 == self.age
+                and depth < self.unpack_depth(old)):
+            return
+        depth = 0xFFFF if depth == np.inf else min(max(depth, -0x7FFF), 0x7FFE) + 0x8000
+        data = (depth | ((EXACT, LOWER, UPPER).index(flag) + 1) << 16 |
+                (self.move_numbers[move] if move is not None else 0) << 18 | self.age << 38)
+        bits, = struct.unpack('<Q', struct.pack('<d', value))
+        self.words[i], self.words[i + 1], self.words[i + 2] = key ^ data ^ bits, data, bits
+        self.stores += 1
+
+    def unpack_depth(self, data):
+        depth = data & 0xFFFF
+        return np.inf if depth == 0xFFFF else depth - 0x8000
+
+    def new_search(self):
+        """Mark the entries stored so far as belonging to an earlier search."""
+        self.age = self.age & ~0xFFFF | (self.age + 1) & 0xFFFF
+
+    def clear(self):
+        np.frombuffer(self.memory.buf, dtype=np.uint64)[:] = 0
+        self.age &= ~0xFFFF
+        self.hits = self.misses = self.stores = 0
+
+    def __len__(self):
+        return int(np.count_nonzero(np.frombuffer(self.memory.buf, dtype=np.uint64)[1::3]))
+
+    def close(self):
+        """Detach this process from the shared memory."""
+        self.words.release()
+        self.memory.close()
+
+
+# ______________________________________________________________________________
+# Opening Books
+
+
+# A record of an opening book file: the key of a position, its score and
+# the depth it was searched to, and a byte standing for the best move.
+BOOK_RECORD = struct.Struct('<QhBB')
+
+BookEntry = namedtuple('BookEntry', 'key, score, depth, move')
+
+
+def write_opening_book(path, entries):
+    """Write the BookEntry entries to path as fixed-size BOOK_RECORDs sorted
+    by key, keeping the last entry given for a key. Scores are clipped to
+    16 bits and depths to 8; what a move byte stands for is up to the game."""
+    entries = {entry.key: entry for entry in entries}
+    with open(path, 'wb') as file:
+        for key in sorted(entries):
+            entry = entries[key]
+            file.write(BOOK_RECORD.pack(key, int(min(max(entry.score, -0x8000), 0x7FFF)),
+                                        min(entry.depth, 0xFF), entry.move))
+
+
+class OpeningBook:
+    """An opening book file written by write_opening_book. The file is
+    memory-mapped rather than read, so opening even a large book is
+    instant and only the pages a lookup touches are ever loaded; as the
+    records are sorted, a lookup is a binary search of them."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            empty = os.fstat(file.fileno()).st_size == 0
+            self.map = b'' if empty else mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.map) // BOOK_RECORD.size
+
+    def lookup(self, key):
+        """Return the BookEntry for key, or None."""
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            entry = BookEntry(*BOOK_RECORD.unpack_from(self.map, middle * BOOK_RECORD.size))
+            if entry.key < key:
+                low = middle + 1
+            elif entry.key > key:
+                high = middle
+            else:
+                return entry
+        return None
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        if self.map:
+            self.map.close()
+
+
+# ______________________________________________________________________________
+# Perft
+
+
+def perft(state, game, depth):
+    """Return the number of positions depth moves below state, found with
+    game.actions and game.result alone, to test and time the generation of
+    moves. Games that end sooner add nothing. In a StochasticGame, a state
+    whose chance is still to come branches on every game.chances outcome
+    first, which is not a move."""
+    if isinstance(game, StochasticGame) and state.chance is None:
+        return sum(perft(game.outcome(state, chance), game, depth)
+                   for chance in game.chances(state))
+    if depth == 0:
+        return 1
+    if game.terminal_test(state):
+        return 0
+    return sum(perft(game.result(state, move), game, depth - 1)
+               for move in game.actions(state))
+
+
+def perft_divide(state, game, depth):
+    """Return perft split by the first move, as a {move: count} dict in
+    the order of game.actions; or by the chance outcome, if state's chance
+    is still to come."""
+    if isinstance(game, StochasticGame) and state.chance is None:
+        return {chance: perft(game.outcome(state, chance), game, depth)
+                for chance in game.chances(state)}
+    if depth == 0 or game.terminal_test(state):
+        return {}
+    return {move: perft(game.result(state, move), game, depth - 1)
+            for move in game.actions(state)}
 
 
 # ______________________________________________________________________________
@@ -213,6 +1343,10 @@ def expect_minmax_player(game, state):
     return expect_minmax(state, game)
 
 
+def mcts_player(game, state):
+    return MCTS(game, iterations=1000).search(state)
+
+
 
 
 
@@ -230,6 +1364,10 @@ class Game:
     need to set the .initial attribute to the initial state; this can
     be done in the constructor."""
 
+    # Whether the evaluation functions of searches score positions symmetric
+    # under canonical alike; if not, see search_key.
+    symmetric_eval = True
+
     def actions(self, state):
         """Return a list of the allowable moves at this point."""
         raise NotImplementedError
@@ -250,6 +1388,62 @@ class Game:
         """Return the player whose move it is in this state."""
         return state.to_move
 
+    def hash_key(self, state):
+        """Return an integer identifying this state, for transposition tables."""
+        return hash(state)
+
+    def canonical(self, state):
+        """Return (key, symmetry): a key shared by state and the positions
+        symmetric to it, and the symmetry taking state to the canonical one
+        (see map_move). By default: hash_key(state) and 0, the identity."""
+        return self.hash_key(state), 0
+
+    def search_key(self, state, heuristic):
+        """Return (key, symmetry) to cache a search of state under: canonical,
+        unless the search is heuristic and symmetric_eval is False, when
+        symmetric positions may score differently; then hash_key(state), 0."""
+        if heuristic and not self.symmetric_eval:
+            return self.hash_key(state), 0
+        return self.canonical(state)
+
+    def map_move(self, move, symmetry, inverse=False):
+        """Return the image of move under symmetry, a symmetry returned by
+        canonical; with inverse, the move whose image move is."""
+        return move
+
+    def forcing_moves(self, state):
+        """Return (moves, quiet) for a quiescence search: the moves of state to
+        search past the horizon, and whether its evaluation may stand. By
+        default every state is quiet, with no forcing moves."""
+        return [], True
+
+    def mutable(self, state):
+        """Return a MutableState copy of state for make and unmake. This is
+        optional: only games searched with in_place need it."""
+        raise NotImplementedError
+
+    def make(self, state, move):
+        """Make a move on a mutable state in place, and return an undo token
+        for unmake."""
+        raise NotImplementedError
+
+    def unmake(self, state, undo):
+        """Take back the move make returned the undo token for, restoring
+        the mutable state to what it was before."""
+        raise NotImplementedError
+
+    def pack(self, state):
+        """Return state packed into a short bytes string, which unpack turns
+        back into the state. Two states pack equal exactly when they are
+        equal, so packed states serve as cache keys, and millions of them
+        fit where frontiers and caches would hold far fewer states. This is
+        optional: only callers storing many states need it."""
+        raise NotImplementedError
+
+    def unpack(self, data):
+        """Return the state that pack packed into data."""
+        raise NotImplementedError
+
     def display(self, state):
         """Print or otherwise display the state."""
         print(state)
@@ -335,6 +1529,7 @@ class Fig52Extended(Game):
 
     succs = {i: dict(l=i * 3 + 1, m=i * 3 + 2, r=i * 3 + 3) for i in range(13)}
     utils = dict()
+    initial = 0
 
     def actions(self, state):
         return sorted(list(self.succs.get(state, {}).keys()))
@@ -401,6 +1596,31 @@ class Backgammon(StochasticGame):
                                    board=board,
                                    moves=self.get_all_moves(board, to_move), chance=None)
 
+    def mutable(self, state):
+        board = [point.copy() for point in state.board]
+        return MutableState(**state._replace(board=board)._asdict())
+
+    def make(self, state, move):
+        player = state.to_move
+        undo = (move, player, state.utility, state.moves, state.chance)
+        self.move_checker(state.board, move[0], state.chance[0], player)
+        if len(move) == 2:
+            self.move_checker(state.board, move[1], state.chance[1], player)
+        state.to_move = ('W' if player == 'B' else 'B')
+        state.utility = self.compute_utility(state.board, move, player)
+        state.moves = self.get_all_moves(state.board, state.to_move)
+        state.chance = None
+        return undo
+
+    def unmake(self, state, undo):
+        move, player, state.utility, state.moves, chance = undo
+        for start, steps in reversed(list(zip(move, chance))):
+            dest = start + steps
+            state.board[start][player] += 1
+            if dest in range(0, 24):
+                state.board[dest][player] -= 1
+        state.to_move, state.chance = player, chance
+
     def utility(self, state, player):
         """Return the value to player; 1 for win, -1 for loss, 0 otherwise."""
         return state.utility if player == 'W' else -state.utility
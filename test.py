@@ -1,3 +1,8 @@
+import argparse
+import json
+import os
+import pickle
+
 import pygame.draw
 from games import *
 
@@ -15,7 +20,7 @@ WIDTH = COLUMN_COUNT * SQUARESIZE
 HEIGHT = (ROW_COUNT + GAP_ROWS) * SQUARESIZE
 
 SIZE = (WIDTH, HEIGHT)
-SCREEN = pygame.display.set_mode(SIZE)
+SCREEN = None  # The game window, opened by __main__
 
 BLACK = (0, 0, 0)
 BLUE = (0, 0, 255)
@@ -26,53 +31,90 @@ GREEN = (61, 145, 64)
 
 RADIUS = SQUARESIZE // 3
 
+FPS = 60
+
 FONT = pygame.font.SysFont("verdana", 60)
 
+# How long the computer and the tutor may think about a move. Deployments
+# trade search depth for latency by setting TUTOR_TIME_MS and/or TUTOR_NODES.
+TIME_BUDGET_MS = int(os.environ.get("TUTOR_TIME_MS", 1000))
+NODE_BUDGET = int(os.environ.get("TUTOR_NODES", 0)) or None
+# Half width of the root window searched first, in evaluation_function points
+ASPIRATION = 10
+# Nodes the search may add past each leaf along forcing moves (see ConnectFour.forcing_moves)
+QUIESCENCE = 32
+# The opening book consulted before searching, written by --build-book
+BOOK_PATH = os.environ.get("TUTOR_BOOK", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                      "connect4.book"))
+# The results --benchmark compares against, written by --save-baseline
+BENCHMARK_PATH = os.environ.get("TUTOR_BENCHMARK",
+                                os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             "benchmark.json"))
+
 
 class Game(Game):
-    def play_test(self, player):
-        """Play an n-person, move-alternating game."""
+    def play_test(self, player=None):
+        """Play an n-person, move-alternating game. The computer's moves, by
+        player if given, and the tutor's suggestions are searched on a
+        background thread, so the window stays responsive."""
         state = self.initial
+        service = tutor_service(self)
+        submitted = drawn = suggested_move = drawn_suggestion = None
+        clock = pygame.time.Clock()
         print(player)
         while True:
+            if state is not submitted:
+                service.submit(state, player if state.to_move == 'X' else None)
+                submitted = state
+            analysis = service.poll()
             if state.to_move == 'X':
-                move = player(self, state)
-                print("alpha_beta_move: ", move)
-                state = self.result(state, move)
-                if self.terminal_test(state):
-                    self.draw_board(state)
-                    return self.utility(state, self.to_move(self.initial))
+                if analysis is not None and analysis.done:
+                    move = analysis.move
+                    print("alpha_beta_move: ", move)
+                    state = self.result(state, move)
+                    if self.terminal_test(state):
+                        service.close()
+                        self.draw_board(state)
+                        return self.utility(state, self.to_move(self.initial))
             elif state.to_move == 'O':
-                self.draw_board(state)
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        sys.exit()
-                    if event.type == pygame.MOUSEBUTTONDOWN:
-                        pos_mouse = event.pos
-                        print("x value:", pos_mouse[0])
-                        column_value = (pos_mouse[0] // SQUARESIZE) + 1
-                        print("column_click_in: ", column_value)
-                        for move in self.actions(state):
-                            if move[1] == column_value:
-                                print("Move is: ", move)
-                                break
-                        state = self.result(state, move)
-                        if self.terminal_test(state):
-                            self.draw_board(state)
-                            return self.utility(state, self.to_move(self.initial))
-                    if event.type == pygame.MOUSEMOTION:
-                        pygame.draw.rect(SCREEN, BLACK, (0, 0, WIDTH, SQUARESIZE))
-                        slider_pos = event.pos[0]
-                        pygame.draw.circle(SCREEN, YELLOW, (slider_pos, SQUARESIZE // 2), RADIUS)
+                if analysis is not None:
+                    suggested_move = analysis.move
+                if state is not drawn or suggested_move != drawn_suggestion:
+                    self.draw_board(state, suggested_move)
+                    drawn, drawn_suggestion = state, suggested_move
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    sys.exit()
+                if event.type == pygame.MOUSEBUTTONDOWN and state.to_move == 'O':
+                    pos_mouse = event.pos
+                    print("x value:", pos_mouse[0])
+                    column_value = (pos_mouse[0] // SQUARESIZE) + 1
+                    print("column_click_in: ", column_value)
+                    for move in self.actions(state):
+                        if move[1] == column_value:
+                            print("Move is: ", move)
+                            break
+                    state = self.result(state, move)
+                    suggested_move = None
+                    if self.terminal_test(state):
+                        service.close()
+                        self.draw_board(state)
+                        return self.utility(state, self.to_move(self.initial))
+                if event.type == pygame.MOUSEMOTION:
+                    pygame.draw.rect(SCREEN, BLACK, (0, 0, WIDTH, SQUARESIZE))
+                    slider_pos = event.pos[0]
+                    pygame.draw.circle(SCREEN, YELLOW, (slider_pos, SQUARESIZE // 2), RADIUS)
             pygame.display.update()
+            clock.tick(FPS)
             
 
 
 class TicTacToe(Game):
     """Play TicTacToe on an h x v board, with Max (first player) playing 'X'.
     A state has the player to move, a cached utility, a list of moves in
-    the form of a list of (x, y) positions, and a board, in the form of
-    a dict of {(x, y): Player} entries, where Player is 'X' or 'O'."""
+    the form of a list of (x, y) positions, a board, in the form of
+    a dict of {(x, y): Player} entries, where Player is 'X' or 'O', the
+    Zobrist key of the board and the keys of its symmetric images."""
 
     def __init__(self, h=3, v=3, k=3):
         self.h = h
@@ -80,7 +122,34 @@ class TicTacToe(Game):
         self.k = k
         moves = [(x, y) for x in range(1, h + 1)
                  for y in range(1, v + 1)]
-        self.initial = GameState(to_move='X', utility=0, board={}, moves=moves)
+        self.squares = list(moves)
+        self.zobrist = zobrist_keys([(move, player) for move in moves for player in 'XO'])
+        # For every square and each direction a line of k squares through it
+        # fits in, the squares up to k - 1 away ahead of it and behind it.
+        self.rays = {}
+        for x, y in moves:
+            self.rays[x, y] = rays = []
+            for delta_x, delta_y in ((0, 1), (1, 0), (1, -1), (1, 1)):
+                ahead, behind = [], []
+                for i in range(1, k):
+                    if 1 <= x + i * delta_x <= h and 1 <= y + i * delta_y <= v:
+                        ahead.append((x + i * delta_x, y + i * delta_y))
+                    if 1 <= x - i * delta_x <= h and 1 <= y - i * delta_y <= v:
+                        behind.append((x - i * delta_x, y - i * delta_y))
+                if len(ahead) + len(behind) + 1 >= k:
+                    rays.append((tuple(ahead), tuple(behind)))
+        self.symmetries = self.board_symmetries()
+        self.inverse_symmetries = [{image: square for square, image in symmetry.items()}
+                                   for symmetry in self.symmetries]
+        # The keys a token adds to the images of the board, symmetry by symmetry
+        self.image_keys = {(move, player): tuple(self.zobrist[symmetry[move], player]
+                                                 for symmetry in self.symmetries)
+                           for move in moves for player in 'XO'}
+        # A packed board is a number in base 3 with a digit per square, times
+        # 2 plus 1 if O is to move
+        self.nbytes = ((2 * 3 ** len(moves) - 1).bit_length() + 7) // 8
+        self.initial = GameState(to_move='X', utility=0, board={}, moves=moves, key=0,
+                                 images=(0,) * len(self.symmetries))
 
     def actions(self, state):
         """Legal moves are any square not yet taken."""
@@ -89,13 +158,61 @@ class TicTacToe(Game):
     def result(self, state, move):
         if move not in self.actions(state):
             return state  # Illegal move has no effect
+        state = self.keyed(state)
         board = state.board.copy()
         board[move] = state.to_move
         moves = list(state.moves)
         moves.remove(move)
         return GameState(to_move=('O' if state.to_move == 'X' else 'X'),
                          utility=self.compute_utility(board, move, state.to_move),
-                         board=board, moves=moves)
+                         board=board, moves=moves,
+                         key=state.key ^ self.zobrist[move, state.to_move],
+                         images=self.add_images(state.images, move, state.to_move))
+
+    def mutable(self, state):
+        state = self.keyed(state)._replace(board=dict(state.board), moves=list(state.moves))
+        return MutableState(**state._asdict())
+
+    def make(self, state, move):
+        player = state.to_move
+        index = state.moves.index(move)
+        undo = (move, index, state.utility, state.key, state.images)
+        del state.moves[index]
+        state.board[move] = player
+        state.to_move = ('O' if player == 'X' else 'X')
+        state.utility = self.compute_utility(state.board, move, player)
+        state.key ^= self.zobrist[move, player]
+        state.images = self.add_images(state.images, move, player)
+        return undo
+
+    def unmake(self, state, undo):
+        move, index, state.utility, state.key, state.images = undo
+        state.to_move = state.board.pop(move)
+        state.moves.insert(index, move)
+
+    def pack(self, state):
+        """Only the board and the player to move are packed, into 2 bytes on
+        a 3x3 board; unpack works out the rest again."""
+        number = 0
+        for square in reversed(self.squares):
+            number = 3 * number + '.XO'.index(state.board.get(square, '.'))
+        return (2 * number + (state.to_move == 'O')).to_bytes(self.nbytes, 'little')
+
+    def unpack(self, data):
+        number = int.from_bytes(data, 'little')
+        to_move, number = 'XO'[number % 2], number // 2
+        board, moves, utility = {}, [], 0
+        for square in self.squares:
+            number, cell = divmod(number, 3)
+            if cell:
+                board[square] = '.XO'[cell]
+            else:
+                moves.append(square)
+        for square, player in board.items():
+            utility = utility or self.compute_utility(board, square, player)
+        key, images = self.board_keys(board)
+        return GameState(to_move=to_move, utility=utility, board=board, moves=moves, key=key,
+                         images=images)
 
     def utility(self, state, player):
         """Return the value to player; 1 for win, -1 for loss, 0 otherwise."""
@@ -105,6 +222,56 @@ class TicTacToe(Game):
         """A state is terminal if it is won or there are no empty squares."""
         return state.utility != 0 or len(state.moves) == 0
 
+    def hash_key(self, state):
+        return state.key if state.key is not None else self.keyed(state).key
+
+    def board_keys(self, board):
+        """Return the key of board and the keys of its images."""
+        key, images = 0, (0,) * len(self.symmetries)
+        for square, player in board.items():
+            key ^= self.zobrist[square, player]
+            images = self.add_images(images, square, player)
+        return key, images
+
+    def keyed(self, state):
+        """Return state, with its keys worked out from the board if missing."""
+        if state.key is None or state.images is None:
+            key, images = self.board_keys(state.board)
+            state = state._replace(key=key, images=images)
+        return state
+
+    def board_symmetries(self):
+        """Return the symmetries of the board other than the identity, each
+        as a dict mapping every square to its image: the two reflections
+        and the half turn, and on a square board the two diagonal
+        reflections and the quarter turns as well."""
+        h, v = self.h, self.v
+        maps = [lambda x, y: (h + 1 - x, y), lambda x, y: (x, v + 1 - y),
+                lambda x, y: (h + 1 - x, v + 1 - y)]
+        if h == v:
+            maps += [lambda x, y: (y, x), lambda x, y: (v + 1 - y, h + 1 - x),
+                     lambda x, y: (y, h + 1 - x), lambda x, y: (v + 1 - y, x)]
+        squares = [(x, y) for x in range(1, h + 1) for y in range(1, v + 1)]
+        return [{square: image(*square) for square in squares} for image in maps]
+
+    def add_images(self, images, move, player):
+        """Return the keys of images once player has moved to move."""
+        return tuple(key ^ image for key, image in zip(images, self.image_keys[move, player]))
+
+    def canonical(self, state):
+        """The canonical image of a board is the one with the smallest key;
+        symmetry n > 0 is self.symmetries[n - 1]."""
+        state = self.keyed(state)
+        keys = (state.key,) + state.images
+        key = min(keys)
+        return key, keys.index(key)
+
+    def map_move(self, move, symmetry, inverse=False):
+        if move is None or not symmetry:
+            return move
+        maps = self.inverse_symmetries if inverse else self.symmetries
+        return maps[symmetry - 1][move]
+
     def display(self, state):
         board = state.board
         for x in range(1, self.h + 1):
@@ -114,13 +281,19 @@ class TicTacToe(Game):
 
     def compute_utility(self, board, move, player):
         """If 'X' wins with this move, return 1; if 'O' wins return -1; else return 0."""
-        if (self.k_in_row(board, move, player, (0, 1)) or
-                self.k_in_row(board, move, player, (1, 0)) or
-                self.k_in_row(board, move, player, (1, -1)) or
-                self.k_in_row(board, move, player, (1, 1))):
-            return +1 if player == 'X' else -1
-        else:
-            return 0
+        for ahead, behind in self.rays[move]:
+            n = 1  # n is number of moves in row
+            for square in ahead:
+                if board.get(square) != player:
+                    break
+                n += 1
+            for square in behind:
+                if board.get(square) != player:
+                    break
+                n += 1
+            if n >= self.k:
+                return +1 if player == 'X' else -1
+        return 0
 
     def k_in_row(self, board, move, player, delta_x_y):
         """Return true if there is a line through move on board for player."""
@@ -138,22 +311,307 @@ class TicTacToe(Game):
         return n >= self.k
 
 
+class ConnectFourState(namedtuple('ConnectFourState',
+                                  'to_move, utility, x_bits, o_bits, free, key, images, '
+                                  'score')):
+    """A ConnectFour position as one integer bitboard per player, square
+    (x, y) at bit (x - 1) * (v + 1) + (y - 1), and the number of empty
+    squares of every column. key, images and score are kept up to date as
+    for TicTacToe states and evaluation_function."""
+
+    __slots__ = ()
+
+    @property
+    def board(self):
+        """The {(x, y): Player} dict used by TicTacToe states, built on demand."""
+        board = {}
+        stride = len(self.free) + 1
+        bits = self.x_bits | self.o_bits
+        while bits:
+            bit = bits & -bits
+            x, y = divmod(bit.bit_length() - 1, stride)
+            board[(x + 1, y + 1)] = 'X' if self.x_bits & bit else 'O'
+            bits ^= bit
+        return board
+
+
 class ConnectFour(TicTacToe):
     """A TicTacToe-like game in which you can only make a move on the bottom
     row, or in a square directly above an occupied square.  Traditionally
     played on a 7x6 board and requiring 4 in a row."""
 
+    # The streaks of evaluation_function are not mirror symmetric
+    symmetric_eval = False
+
     def __init__(self, h=7, v=6, k=4):
         TicTacToe.__init__(self, h, v, k)
+        self.stride = v + 1
+        # Columns listed from the center out, as central tokens are worth more.
+        self.columns = sorted(range(v), key=lambda column: abs(2 * column + 1 - v))
+        # Shifts to the next square along a vertical, horizontal and both diagonals.
+        self.shifts = (self.stride, 1, self.stride - 1, self.stride + 1)
+        # The bits of every square of the board, of the bottom row and of
+        # every column
+        self.full = sum(1 << (row * self.stride + column)
+                        for row in range(h) for column in range(v))
+        self.bottom = sum(1 << ((h - 1) * self.stride + column) for column in range(v))
+        self.column_bits = [sum(1 << (row * self.stride + column) for row in range(h))
+                            for column in range(v)]
+        # A packed board has h + 1 bits per column: a bit per token, 1 for X,
+        # from the bottom up, then a 1 to mark the top; and a last bit set
+        # if O is to move
+        self.nbytes = (v * (h + 1) + 8) // 8
+        # For every square, the (other squares, points) of each streak through it
+        # scored by evaluation_function: a token dropped there completes the
+        # streak when its owner already holds the other squares.
+        windows, weights, nbits = streak_table(v)
+        self.streaks = [[] for _ in range(max(nbits, h * self.stride))]
+        for window, weight in zip(windows.reshape(-1, 4).tolist(), weights.tolist()):
+            squares = set(window)
+            if max(squares) < h * self.stride:
+                for square in squares:
+                    others = sum(1 << other for other in squares - {square})
+                    self.streaks[square].append((others, weight))
+        self.initial = ConnectFourState(to_move='X', utility=0, x_bits=0, o_bits=0,
+                                        free=(h,) * v, key=0, images=(0,), score=0)
 
     def actions(self, state):
-        return [(x, y) for (x, y) in state.moves
-                if x == self.h or (x + 1, y) in state.board]
+        """Legal moves drop a token on top of any column that is not full,
+        listed center column first."""
+        free = state.free
+        return [(free[column], column + 1) for column in self.columns if free[column]]
+
+    def result(self, state, move):
+        x, y = move
+        column = y - 1
+        if not 0 <= column < self.v or x != state.free[column] or not x:
+            return state  # Illegal move has no effect
+        square = (x - 1) * self.stride + column
+        bit = 1 << square
+        free = state.free[:column] + (x - 1,) + state.free[column + 1:]
+        key = state.key ^ self.zobrist[move, state.to_move]
+        images = self.add_images(state.images, move, state.to_move)
+        own = state.x_bits if state.to_move == 'X' else state.o_bits
+        points = self.streak_points(own, square)
+        if state.to_move == 'X':
+            x_bits = state.x_bits | bit
+            return ConnectFourState(to_move='O', utility=+1 if self.connected(x_bits) else 0,
+                                    x_bits=x_bits, o_bits=state.o_bits, free=free, key=key,
+                                    images=images, score=state.score + points)
+        o_bits = state.o_bits | bit
+        return ConnectFourState(to_move='X', utility=-1 if self.connected(o_bits) else 0,
+                                x_bits=state.x_bits, o_bits=o_bits, free=free, key=key,
+                                images=images, score=state.score - points)
+
+    def mutable(self, state):
+        return MutableState(**state._replace(free=list(state.free))._asdict())
 
-    def draw_board(self, state):
+    def make(self, state, move):
+        x, y = move
+        square = (x - 1) * self.stride + y - 1
+        undo = (move, state.utility, state.key, state.images, state.score)
+        player = state.to_move
+        own = state.x_bits if player == 'X' else state.o_bits
+        points = self.streak_points(own, square)
+        own |= 1 << square
+        if player == 'X':
+            state.x_bits, state.to_move, state.score = own, 'O', state.score + points
+        else:
+            state.o_bits, state.to_move, state.score = own, 'X', state.score - points
+        state.free[y - 1] = x - 1
+        state.utility = (+1 if player == 'X' else -1) if self.connected(own) else 0
+        state.key ^= self.zobrist[move, player]
+        state.images = self.add_images(state.images, move, player)
+        return undo
+
+    def unmake(self, state, undo):
+        move, state.utility, state.key, state.images, state.score = undo
+        x, y = move
+        bit = 1 << ((x - 1) * self.stride + y - 1)
+        if state.to_move == 'O':
+            state.x_bits, state.to_move = state.x_bits ^ bit, 'X'
+        else:
+            state.o_bits, state.to_move = state.o_bits ^ bit, 'O'
+        state.free[y - 1] = x
+
+    def terminal_test(self, state):
+        """A state is terminal if it is won or every column is full."""
+        return state.utility != 0 or not any(state.free)
+
+    def pack(self, state):
+        """A ConnectFourState packs into 7 bytes on a 7x6 board."""
+        number = 0
+        for column in reversed(range(self.v)):
+            code = 1
+            for x in range(state.free[column] + 1, self.h + 1):
+                code = 2 * code + (state.x_bits >> ((x - 1) * self.stride + column) & 1)
+            number = (number << (self.h + 1)) | code
+        return (2 * number + (state.to_move == 'O')).to_bytes(self.nbytes, 'little')
+
+    def unpack(self, data):
+        number = int.from_bytes(data, 'little')
+        to_move, number = 'XO'[number % 2], number // 2
+        x_bits = o_bits = key = score = 0
+        images, free = (0,) * len(self.symmetries), []
+        for column in range(self.v):
+            code, number = number & ((2 << self.h) - 1), number >> (self.h + 1)
+            height = code.bit_length() - 1
+            free.append(self.h - height)
+            for x in range(self.h - height + 1, self.h + 1):
+                square = (x - 1) * self.stride + column
+                player = 'X' if code >> (self.h - x) & 1 else 'O'
+                if player == 'X':
+                    score += self.streak_points(x_bits, square)
+                    x_bits |= 1 << square
+                else:
+                    score -= self.streak_points(o_bits, square)
+                    o_bits |= 1 << square
+                key ^= self.zobrist[(x, column + 1), player]
+                images = self.add_images(images, (x, column + 1), player)
+        utility = +1 if self.connected(x_bits) else -1 if self.connected(o_bits) else 0
+        return ConnectFourState(to_move=to_move, utility=utility, x_bits=x_bits, o_bits=o_bits,
+                                free=tuple(free), key=key, images=images, score=score)
+
+    def play_columns(self, columns, state=None):
+        """Return the state reached from state (by default the initial one)
+        by dropping tokens into the given columns in turn, e.g. '4453'."""
+        state = state or self.initial
+        for column in columns:
+            column = int(column)
+            if not 1 <= column <= self.v or not state.free[column - 1]:
+                raise ValueError('cannot drop a token into column {}'.format(column))
+            state = self.result(state, (state.free[column - 1], column))
+        return state
+
+    def playout(self, state, rng):
+        """Drop tokens in random columns from state until the game ends, and
+        return its utility to the player to move in state. An MCTS playout
+        working on the bitboards alone, without making any states."""
+        if self.terminal_test(state):
+            return state.utility if state.to_move == 'X' else -state.utility
+        own, other = state.x_bits, state.o_bits
+        if state.to_move == 'O':
+            own, other = other, own
+        free = list(state.free)
+        columns = [column for column in range(self.v) if free[column]]
+        sign = 1
+        while columns:
+            column = rng.choice(columns)
+            own |= 1 << ((free[column] - 1) * self.stride + column)
+            free[column] -= 1
+            if not free[column]:
+                columns.remove(column)
+            if self.connected(own):
+                return sign
+            own, other, sign = other, own, -sign
+        return 0
+
+    def board_symmetries(self):
+        """Tokens fall down, so the only symmetry is the left-right mirror."""
+        return [{(x, y): (x, self.v + 1 - y)
+                 for x in range(1, self.h + 1) for y in range(1, self.v + 1)}]
+
+    def mirror(self, state):
+        """Return the left-right mirror image of state."""
+        def flip(bits):
+            flipped = 0
+            for square in range(self.h * self.stride):
+                if bits >> square & 1:
+                    x, column = divmod(square, self.stride)
+                    flipped |= 1 << (x * self.stride + self.v - 1 - column)
+            return flipped
+
+        mirrored = state._replace(x_bits=flip(state.x_bits), o_bits=flip(state.o_bits),
+                                  free=state.free[::-1], key=state.images[0],
+                                  images=(state.key,), score=0)
+        # evaluation_function is not symmetric, so score is worked out anew
+        score = int(eval_batch([mirrored._replace(utility=0)])[0])
+        return mirrored._replace(score=score if state.to_move == 'X' else -score)
+
+    def streak_points(self, bits, square):
+        """Return the points of the streaks that a token on square completes
+        for the player holding the squares of bits."""
+        points = 0
+        for others, weight in self.streaks[square]:
+            if bits & others == others:
+                points += weight
+        return points
+
+    def playable(self, mask):
+        """Return the squares a token can be dropped on, given the squares
+        of mask are taken."""
+        return ((mask >> self.stride) | self.bottom) & ~mask
+
+    def threats(self, bits, mask):
+        """Return the squares not in mask that would complete k in a row
+        for the player holding the squares of bits."""
+        k = self.k
+        squares = 0
+        for shift in self.shifts:
+            # after[i] (before[i]) holds the squares followed (preceded) by
+            # i squares of bits in the direction of shift
+            after, before = [-1], [-1]
+            for i in range(1, k):
+                after.append(after[-1] & bits >> (i * shift))
+                before.append(before[-1] & bits << (i * shift))
+            for i in range(k):
+                squares |= before[i] & after[k - 1 - i]
+        return squares & self.full & ~mask
+
+    def bit_move(self, bit):
+        """Return the (x, y) move putting a token on the square of bit."""
+        x, column = divmod(bit.bit_length() - 1, self.stride)
+        return x + 1, column + 1
+
+    def forcing_moves(self, state):
+        """A position is not quiet while the player to move has a win to play
+        or to block; otherwise the forcing moves are double threats."""
+        own, other = state.x_bits, state.o_bits
+        if state.to_move == 'O':
+            own, other = other, own
+        mask = own | other
+        playable = self.playable(mask)
+        wins = playable & self.threats(own, mask)
+        if wins:
+            return [self.bit_move(wins & -wins)], False
+        blocks = playable & self.threats(other, mask)
+        if blocks:
+            return [self.bit_move(bit) for bit in self.bits(blocks)], False
+        return self.double_threats(own, mask, playable), True
+
+    def double_threats(self, own, mask, playable):
+        """Generate the moves among the playable squares with which the
+        player holding own makes a double threat."""
+        for bit in self.bits(playable):
+            threats = self.threats(own | bit, mask | bit)
+            open_threats = threats & self.playable(mask | bit)
+            if open_threats & (open_threats - 1) or open_threats & threats << self.stride:
+                yield self.bit_move(bit)
+
+    def bits(self, squares):
+        """Return the bits of squares one by one."""
+        result = []
+        while squares:
+            bit = squares & -squares
+            result.append(bit)
+            squares ^= bit
+        return result
+
+    def connected(self, bits):
+        """Return true if bits holds k squares in a row in any direction."""
+        k = self.k
+        for shift in self.shifts:
+            line = bits
+            for i in range(1, k):
+                line &= bits >> (i * shift)
+            if line:
+                return True
+        return False
+
+    def draw_board(self, state, suggested_move=None):
+        """Render state, with suggested_move, if any, shown as a green token."""
         board = state.board
         y_buffer = SQUARESIZE * GAP_ROWS
-        suggested_move = alpha_beta_cutoff_player(self, state)
         for column in range(self.v):
             for row in range(self.h):
                 current_square_x = column * SQUARESIZE
@@ -168,151 +626,703 @@ class ConnectFour(TicTacToe):
                     pygame.draw.circle(SCREEN, RED, current_square_center, RADIUS)
                 elif board.get((row + 1, column + 1)) == 'O':
                     pygame.draw.circle(SCREEN, YELLOW, current_square_center, RADIUS)
-                elif row + 1 == suggested_move[0] and column + 1 == suggested_move[1]:
-                    if self.terminal_test(state):
-                        pygame.draw.circle(SCREEN, BLACK, current_square_center, RADIUS)
-                    else:
-                        pygame.draw.circle(SCREEN, GREEN, current_square_center, RADIUS)
+                elif (row + 1, column + 1) == suggested_move and not self.terminal_test(state):
+                    pygame.draw.circle(SCREEN, GREEN, current_square_center, RADIUS)
                 else:
                     pygame.draw.circle(SCREEN, BLACK, current_square_center, RADIUS)
         pygame.display.flip()
         pygame.display.update()
 
 
-def alpha_beta_cutoff_search(state, game, d=4, cutoff_test=None, eval_fn=None):
-    """Search game to determine best action; use alpha-beta pruning.
-    This version cuts off search and uses an evaluation function."""
-
-    player = game.to_move(state)
-
-    # Functions used by alpha_beta
-    def max_value(state, alpha, beta, depth):
-        if cutoff_test(state, depth):
-            return eval_fn(state)
-        v = -np.inf
-        for a in game.actions(state):
-            v = max(v, min_value(game.result(state, a), alpha, beta, depth + 1))
-            if v >= beta:
-                return v
-            alpha = max(alpha, v)
-        return v
-
-    def min_value(state, alpha, beta, depth):
-        if cutoff_test(state, depth):
-            return eval_fn(state)
-        v = np.inf
-        for a in game.actions(state):
-            v = min(v, max_value(game.result(state, a), alpha, beta, depth + 1))
-            if v <= alpha:
-                return v
-            beta = min(beta, v)
-        return v
-
-    # Body of alpha_beta_cutoff_search starts here:
-    # The default test cuts off at depth d or at a terminal state
-    cutoff_test = (cutoff_test or (lambda state, depth: depth > d or game.terminal_test(state)))
-    eval_fn = eval_fn or (lambda state: game.utility(state, player))
-    best_score = -np.inf
-    beta = np.inf
-    best_action = None
-    for a in game.actions(state):
-        v = min_value(game.result(state, a), best_score, beta, 1)
-        if v > best_score:
-            best_score = v
-            best_action = a
-    return best_action
+# Points for every streak of 4, 3 and 2 tokens counted by evaluation_function.
+STREAK_WEIGHTS = ((4, 10), (3, 5), (2, 2))
+# The score of a won game to the winner, more than any streaks add up to.
+WIN_SCORE = 1000
+
+streak_tables = {}
+
+
+def streak_table(columns):
+    """Return (windows, weights, nbits) for boards with this many columns:
+    the bit indexes of the squares of every streak, four by four, the
+    points each scores, and the number of board bits they reach into."""
+    if columns not in streak_tables:
+        stride = columns + 1
+        windows, weights = [], []
+        for row in range(1, 8):
+            for column in range(1, 7):
+                lines = ([(x, column) for x in range(row, 7)],
+                         [(row, y) for y in range(column, 6)],
+                         [(x, column + x - row) for x in range(row, 7)],
+                         [(x, column + row - x) for x in range(row, 0, -1)])
+                for line in lines:
+                    line = [(x, y) for (x, y) in line if y <= 6]
+                    for streak, weight in STREAK_WEIGHTS:
+                        squares = line[:streak]
+                        if len(squares) == streak and all(y <= columns for (x, y) in squares):
+                            bits = [(x - 1) * stride + y - 1 for (x, y) in squares]
+                            windows.append(bits + bits[:1] * (4 - streak))
+                            weights.append(weight)
+        windows = np.array(windows, dtype=np.intp).ravel()
+        streak_tables[columns] = (windows, np.array(weights), int(windows.max()) + 1)
+    return streak_tables[columns]
+
+
+def bit_arrays(bitboards, nbits):
+    """Unpack integer bitboards into the 0/1 rows of an array nbits wide."""
+    nbytes = (nbits + 7) // 8
+    data = b''.join(bits.to_bytes(nbytes, 'little') for bits in bitboards)
+    rows = np.frombuffer(data, dtype=np.uint8).reshape(len(bitboards), nbytes)
+    return np.unpackbits(rows, axis=1, count=nbits, bitorder='little')
 
 
 def evaluation_function(state):
-    if state.to_move == 'X':
-        other_player = 'O'
-    else:
-        other_player = 'X'
-    fours = connect_count(state.board, state.to_move, 4)
-    threes = connect_count(state.board, state.to_move, 3)
-    twos = connect_count(state.board, state.to_move, 2)
-    opp_fours = connect_count(state.board, other_player, 4)
-    opp_threes = connect_count(state.board, other_player, 3)
-    opp_twos = connect_count(state.board, other_player, 2)
-    return (fours * 10 + threes * 5 + twos * 2) - (opp_fours * 10 + opp_threes * 5 + opp_twos * 2)
-
-
-def connect_count(board, player, streak):
-    count = 0
-    for row in range(1, 8):
-        for column in range(1, 7):
-            move = row, column
-            if board.get(move) == player:
-                count += vertical_count(row, column, board, player, streak)
-                count += horizontal_count(row, column, board, player, streak)
-                count += diagonal_count(row, column, board, player, streak)
-    return count
-
-
-def vertical_count(row, column, board, player, streak):
-    count = 0
-    for x in range(row, 7):
-        if board.get((x, column)) == player:
-            count += 1
-        else:
-            break
-    if count >= streak:
-        return 1
-    else:
-        return 0
+    """Score state for the player to move: 10, 5 and 2 points for each of
+    their streaks of 4, 3 and 2 tokens, minus the same for the opponent,
+    or -WIN_SCORE for a game the opponent has won."""
+    if state.utility:
+        return -WIN_SCORE
+    return state.score if state.to_move == 'X' else -state.score
 
 
-def horizontal_count(row, column, board, player, streak):
-    count = 0
-    for y in range(column, 6):
-        if board.get((row, y)) == player:
-            count += 1
+def eval_batch(states):
+    """Return an array with the evaluation_function score of each state,
+    computed from scratch for all of them in a single pass: every streak of
+    the board is checked at once against the windows of streak_table."""
+    if not states:
+        return np.zeros(0, dtype=int)
+    windows, weights, nbits = streak_table(len(states[0].free))
+    bitboards = []
+    for state in states:
+        if state.to_move == 'X':
+            bitboards += (state.x_bits, state.o_bits)
         else:
-            break
-    if count >= streak:
-        return 1
-    else:
-        return 0
+            bitboards += (state.o_bits, state.x_bits)
+    squares = np.take(bit_arrays(bitboards, nbits), windows, axis=1)
+    complete = squares.reshape(len(states), 2, -1, 4).all(axis=3)
+    scores = complete @ weights
+    won = np.array([state.utility != 0 for state in states])
+    return np.where(won, -WIN_SCORE, scores[:, 0] - scores[:, 1])
 
 
-def diagonal_count(row, column, board, player, streak):
-    total = 0
-    count = 0
-    y = column
+def evaluation_for(player):
+    """evaluation_function scores a state for the side to move, but the
+    search needs every leaf scored for player, whatever the depth."""
+    def eval_fn(state):
+        score = evaluation_function(state)
+        return score if state.to_move == player else -score
+    return eval_fn
 
-    for x in range(row, 7):
-        if y > 6:
-            break
-        elif board.get((x, y)) == player:
-            count += 1
-        else:
-            break
-        y += 1
-    if count >= streak:
-        total += 1
-    count = 0
-    y = column
-    for x in range(row, -1, -1):
-        if y > 6:
-            break
-        elif board.get((x, y)) == player:
-            count += 1
+
+def batch_evaluation_for(player):
+    """eval_batch, with every state scored for player."""
+    def batch_eval(states):
+        signs = np.array([1 if state.to_move == player else -1 for state in states])
+        return eval_batch(states) * signs
+    return batch_eval
+
+
+class ConnectFourSolver:
+    """Finds the exact score of ConnectFour positions: 0 for a draw, and
+    otherwise positive if the player to move wins, larger the sooner."""
+
+    def __init__(self, game, tt_size=2 ** 20):
+        self.game = game
+        self.stride = stride = game.stride
+        self.squares = game.h * game.v
+        self.playable, self.threats, self.move = game.playable, game.threats, game.bit_move
+        # Every column, center first
+        self.columns = [game.column_bits[column] for column in game.columns]
+        self.shift = game.h * stride
+        self.tt_size = tt_size
+        self.table = {}
+        self.budget = None
+        self.nodes = 0
+
+    def solve(self, state, weak=False, budget=None):
+        """Return the score of state, raising SearchTimeout if the budget,
+        if given, runs out first."""
+        own, mask, moves = self.position(state)
+        if state.utility:
+            return -1 if weak else -((self.squares + 2 - moves) // 2)  # The last move won
+        if self.threats(own, mask) & self.playable(mask):
+            return 1 if weak else (self.squares + 1 - moves) // 2
+        if weak:
+            lower, upper = -1, 1
         else:
-            break
-        y += 1
-    if count >= streak:
-        total += 1
-    return total
+            lower, upper = -((self.squares - moves) // 2), (self.squares + 1 - moves) // 2
+        self.budget = budget
+        while lower < upper:
+            # Test values near zero first, as most positions score close to it
+            middle = lower + (upper - lower) // 2
+            if middle <= 0 and int(lower / 2) < middle:
+                middle = int(lower / 2)
+            elif middle >= 0 and int(upper / 2) > middle:
+                middle = int(upper / 2)
+            score = self.negamax(own, mask, moves, middle, middle + 1)
+            if score <= middle:
+                upper = score
+            else:
+                lower = score
+        return max(-1, min(lower, 1)) if weak else lower
+
+    def best_move(self, state, budget=None):
+        """Return (move, score): a move of state keeping its score, which is
+        returned as well."""
+        game = self.game
+        own, mask, moves = self.position(state)
+        playable = self.playable(mask)
+        won = self.threats(own, mask) & playable
+        if won:
+            return self.move(won & -won), (self.squares + 1 - moves) // 2
+        score = self.solve(state, budget=budget)
+        actions = game.actions(state)
+        for move in actions:
+            child_own, child_mask, _ = self.position(game.result(state, move))
+            if self.threats(child_own, child_mask) & self.playable(child_mask):
+                continue  # Lets the opponent win at once
+            # Null window test of whether the reply scores -score at most
+            if -self.negamax(child_own, child_mask, moves + 1, -score, 1 - score) >= score:
+                return move, score
+        return actions[0], score  # Every move loses as fast
+
+    def position(self, state):
+        """Return the bits of the player to move, of all tokens, and their number."""
+        mask = state.x_bits | state.o_bits
+        own = state.x_bits if state.to_move == 'X' else state.o_bits
+        return own, mask, bin(mask).count('1')
+
+    def negamax(self, own, mask, moves, alpha, beta):
+        """Return the score of the position within (alpha, beta), given that
+        the player to move, holding the squares of own, cannot win at once."""
+        self.nodes += 1
+        if self.budget is not None:
+            self.budget.tick()
+        other = own ^ mask
+        playable = self.playable(mask)
+        threats = self.threats(other, mask)
+        forced = playable & threats
+        if forced:
+            if forced & (forced - 1):
+                return -((self.squares - moves) // 2)  # Two threats, one block
+            playable = forced
+        # A token right below an opponent's threat lets them play it
+        playable &= ~(threats << self.stride)
+        if not playable:
+            return -((self.squares - moves) // 2)
+        if moves >= self.squares - 2:
+            return 0
+        lower = -((self.squares - 2 - moves) // 2)
+        if alpha < lower:
+            alpha = lower
+            if alpha >= beta:
+                return alpha
+        upper = (self.squares - 1 - moves) // 2
+        if beta > upper:
+            beta = upper
+            if alpha >= beta:
+                return beta
+        key = mask << self.shift | own
+        entry = self.table.get(key)
+        if entry is not None:
+            flag, value = entry
+            if flag == LOWER and value > alpha:
+                alpha = value
+            elif flag == UPPER and value < beta:
+                beta = value
+            if alpha >= beta:
+                return value
+        candidates = []
+        for column in self.columns:
+            bit = playable & column
+            if bit:
+                candidates.append((bin(self.threats(own | bit, mask | bit)).count('1'), bit))
+        candidates.sort(key=lambda candidate: -candidate[0])
+        for _, bit in candidates:
+            score = -self.negamax(other, mask | bit, moves + 1, -beta, -alpha)
+            if score >= beta:
+                self.store(key, LOWER, score)
+                return score
+            if score > alpha:
+                alpha = score
+        self.store(key, UPPER, alpha)
+        return alpha
+
+    def store(self, key, flag, value):
+        if len(self.table) >= self.tt_size:
+            self.table.clear()
+        self.table[key] = flag, value
+
+
+solvers = {}
+
+
+def solved_move(game, state, budget=None):
+    """Return the best move in state as a ConnectFourSolver finds it, or
+    None if the board is less than half full or the solver runs out of
+    half of what is left of budget (by default, of the time and node
+    budgets of a move)."""
+    if game.terminal_test(state) or 2 * sum(state.free) > game.h * game.v:
+        return None
+    if game not in solvers:
+        solvers[game] = ConnectFourSolver(game)
+    budget = budget if budget is not None else SearchBudget(TIME_BUDGET_MS / 1000, NODE_BUDGET)
+    part = budget.part(0.5)
+    try:
+        move, score = solvers[game].best_move(state, part)
+    except SearchTimeout:
+        return None
+    finally:
+        budget.nodes += part.nodes
+    return move
+
+
+books = {}
+
+
+def opening_book():
+    """Return the OpeningBook at BOOK_PATH, or None if there is none."""
+    if BOOK_PATH not in books:
+        books[BOOK_PATH] = OpeningBook(BOOK_PATH) if os.path.exists(BOOK_PATH) else None
+    return books[BOOK_PATH]
+
+
+def book_move(game, state):
+    """Return the move the opening book gives for state, or None. Mirror
+    images share an entry, kept under their canonical key, whose move byte
+    is the column to play in the canonical image."""
+    book = opening_book()
+    if book is None or game.terminal_test(state):
+        return None
+    key, symmetry = game.canonical(state)
+    entry = book.lookup(key)
+    if entry is None:
+        return None
+    # Mirroring keeps rows, so any row maps the column
+    column = game.map_move((1, entry.move), symmetry, inverse=True)[1]
+    return state.free[column - 1], column
+
+
+def build_book(game, path, plies, depth):
+    """Search every position up to plies moves into the game depth plies
+    deep, and write the best moves to an opening book at path. Of two
+    mirror images, the canonical one is searched. The positions, and those
+    of the next ply, are held packed."""
+    positions = {}
+    states = [game.pack(game.initial)]
+    for ply in range(plies + 1):
+        children = []
+        for data in states:
+            state = game.unpack(data)
+            key, symmetry = game.canonical(state)
+            if key in positions or game.terminal_test(state):
+                continue
+            positions[key] = game.pack(game.mirror(state) if symmetry else state)
+            children += [game.pack(game.result(state, move)) for move in game.actions(state)]
+        states = children
+    tt, ordering = TranspositionTable(2 ** 20), MoveOrdering()
+    entries = []
+    for key, data in positions.items():
+        state = game.unpack(data)
+        result = principal_variation_search(state, game, depth,
+                                            eval_fn=evaluation_for(game.to_move(state)),
+                                            tt=tt, ordering=ordering)
+        entries.append(BookEntry(key, result.score, depth, result.move[1]))
+    write_opening_book(path, entries)
+    return len(entries)
 
 
 def alpha_beta_cutoff_player(game, state):
-    return alpha_beta_cutoff_search(state, game, d=4, cutoff_test=None, eval_fn=evaluation_function)
+    budget = SearchBudget(TIME_BUDGET_MS / 1000, NODE_BUDGET)
+    move = book_move(game, state) or solved_move(game, state, budget)
+    if move is not None:
+        return move
+    return iterative_deepening_search(state, game, budget=budget,
+                                      eval_fn=evaluation_for(game.to_move(state)),
+                                      aspiration=ASPIRATION, quiescence=QUIESCENCE)
+
+
+def mtdf_player(game, state):
+    """alpha_beta_cutoff_player, searching every depth with mtdf_search."""
+    return iterative_deepening_search(state, game, time_limit=TIME_BUDGET_MS / 1000,
+                                      node_limit=NODE_BUDGET,
+                                      eval_fn=evaluation_for(game.to_move(state)), mtdf=True,
+                                      quiescence=QUIESCENCE)
+
+
+def tutor_service(game):
+    """An AnalysisService searching game like alpha_beta_cutoff_player,
+    and pondering while the other side thinks. Once the board is half full
+    the moves suggested are exact, as the solver finds them."""
+    return AnalysisService(game, time_limit=TIME_BUDGET_MS / 1000, node_limit=NODE_BUDGET,
+                           eval_fn_for=evaluation_for, ponder=True,
+                           book=lambda state, budget: (book_move(game, state) or
+                                                       solved_move(game, state, budget)),
+                           quiescence=QUIESCENCE, aspiration=ASPIRATION)
+
+
+def analyze_file(path, game, depth=None, chunk=4096, workers=None):
+    """Print the score of every position in the file at path, given one per
+    line as the columns played (e.g. 4453; '#' starts a comment). Positions
+    are scored chunk at a time by a single eval_batch call. With depth, the
+    move alpha_beta_cutoff_search finds that deep is printed as well; with
+    workers, that search is split between as many processes."""
+    with open(path) as file:
+        positions = [line.split('#')[0].strip() for line in file]
+    positions = [columns for columns in positions if columns]
+    parallel = ParallelSearch(workers) if depth is not None and workers else None
+    for start in range(0, len(positions), chunk):
+        batch = positions[start:start + chunk]
+        states = [game.play_columns(columns) for columns in batch]
+        for columns, state, score in zip(batch, states, eval_batch(states)):
+            fields = [columns, score]
+            if parallel is not None:
+                fields.append(parallel.search(state, game, depth, eval_fn_for=evaluation_for).move)
+            elif depth is not None:
+                player = game.to_move(state)
+                fields.append(alpha_beta_cutoff_search(state, game, depth,
+                                                       eval_fn=evaluation_for(player),
+                                                       batch_eval=batch_evaluation_for(player)))
+            print(*fields, sep='\t')
+    if parallel is not None:
+        parallel.close()
+
+
+# ______________________________________________________________________________
+# Benchmark
+
+
+# How each player is benchmarked: search(game, state, stats, depth, eval_fn)
+# returns its move, searching depth plies deep where a depth is given.
+# alpha_beta_player is left out: it makes the very same
+# principal_variation_search call as minmax_player.
+BENCHMARK_PLAYERS = {
+    'minmax_player': lambda game, state, stats, depth, eval_fn:
+        minmax_decision(state, game, stats=stats),
+    # At a fixed depth, and without the book, solver and time budget of
+    # alpha_beta_cutoff_player, so that every run searches the same tree
+    'alpha_beta_cutoff_player': lambda game, state, stats, depth, eval_fn:
+        iterative_deepening_search(state, game, max_depth=depth, eval_fn=eval_fn,
+                                   aspiration=ASPIRATION, quiescence=QUIESCENCE, stats=stats),
+    'expect_minmax_player': lambda game, state, stats, depth, eval_fn:
+        expect_minmax(state, game, stats=stats),
+}
+
+
+def backgammon_endgame(white, black, roll):
+    """Return a Backgammon game and the position after the given roll in
+    which White has a checker on every point of white and Black on every
+    point of black, both bearing off: small enough for expect_minmax to
+    search to the end."""
+    game = Backgammon()
+    board = [{'W': 0, 'B': 0} for _ in range(24)]
+    for point in white:
+        board[point]['W'] += 1
+    for point in black:
+        board[point]['B'] += 1
+    game.allow_bear_off = {'W': True, 'B': True}
+    state = StochasticGameState(to_move='W', utility=0, board=board,
+                                moves=game.get_all_moves(board, 'W'), chance=None)
+    return game, game.outcome(state, roll)
+
+
+def benchmark_corpus():
+    """Return the fixed positions benchmarked, as (game name, position name,
+    game, state, players, depth, eval_fn) tuples: the players run on the
+    position, and the depth and evaluation function of the ones that
+    cut off their search."""
+    tictactoe = TicTacToe()
+    connect_four = ConnectFour(6, 7, 4)
+    fig52 = Fig52Extended()
+    # Fig52Extended comes without utilities; give every state below the
+    # root fixed ones, which cut off searches also take as evaluations
+    rng = random.Random(52)
+    fig52.utils = {node: rng.randint(-20, 20) for node in range(1, 40)}
+    full = ['minmax_player', 'alpha_beta_cutoff_player']
+    corpus = [('Fig52Extended', 'root', fig52, fig52.initial, full, 3, None)]
+    for name, moves in [('empty', []), ('corner', [(1, 1)]), ('center', [(2, 2), (1, 1)])]:
+        state = tictactoe.initial
+        for move in moves:
+            state = tictactoe.result(state, move)
+        corpus.append(('TicTacToe', name, tictactoe, state, full, 9, None))
+    for columns in ['', '4453', '444333']:
+        state = connect_four.play_columns(columns)
+        corpus.append(('ConnectFour', columns or 'empty', connect_four, state,
+                       ['alpha_beta_cutoff_player'], 6,
+                       evaluation_for(connect_four.to_move(state))))
+    # Too many moves are left for minmax_player, which does not prune
+    late = '532144764564634466353163'
+    corpus.append(('ConnectFour', late, connect_four, connect_four.play_columns(late),
+                   ['alpha_beta_cutoff_player'], 6, evaluation_for('X')))
+    for roll in [(1, 2), (1, 1)]:
+        game, state = backgammon_endgame((1, 3), (22,), roll)
+        corpus.append(('Backgammon', 'endgame {}{}'.format(*roll), game, state,
+                       ['expect_minmax_player'], None, None))
+    return corpus
+
+
+def run_benchmark(repeat=5):
+    """Search every position of benchmark_corpus() with each of its players
+    repeat times, and return a list of results: the move found, the nodes
+    searched, the seconds taken by the fastest run and the nodes per
+    second, the seconds taken to finish every depth, and the effective
+    branching factor."""
+    results = []
+    for game_name, position, game, state, players, depth, eval_fn in benchmark_corpus():
+        for player in players:
+            search = BENCHMARK_PLAYERS[player]
+            best = None
+            for _ in range(repeat):
+                stats = SearchStats()
+                move = search(game, state, stats, depth, eval_fn)
+                if best is None or stats.seconds < best[1].seconds:
+                    best = move, stats
+            move, stats = best
+            time_to_depth, seconds = {}, 0
+            for iteration in stats.iterations:
+                seconds += iteration['seconds']
+                if iteration['depth'] is not None:
+                    time_to_depth[str(iteration['depth'])] = seconds
+            results.append({'game': game_name, 'position': position, 'player': player,
+                            # Tuples come back from JSON as lists
+                            'move': json.loads(json.dumps(move)), 'nodes': stats.nodes,
+                            'seconds': stats.seconds,
+                            'nodes_per_second': stats.nodes / stats.seconds,
+                            'time_to_depth': time_to_depth,
+                            'branching_factor': stats.branching_factor})
+    return results
+
+
+def compare_benchmark(results, baseline, tolerance=0.25, min_seconds=0.05):
+    """Return the regressions of results against the baseline results, as
+    messages: a move that changed, or a search that takes more than
+    tolerance more nodes, or runs more than tolerance fewer nodes per
+    second, than it used to. Searches that took less than min_seconds are
+    too quick to time reliably, and only their moves and nodes count."""
+    before = {(r['game'], r['position'], r['player']): r for r in baseline}
+    regressions = []
+    for result in results:
+        key = (result['game'], result['position'], result['player'])
+        old = before.get(key)
+        if old is None:
+            continue
+        name = '{} {} {}'.format(*key)
+        if result['move'] != old['move']:
+            regressions.append('{}: plays {} instead of {}'.format(name, result['move'],
+                                                                    old['move']))
+        if result['nodes'] > old['nodes'] * (1 + tolerance):
+            regressions.append('{}: searches {} nodes instead of {}'.format(name, result['nodes'],
+                                                                           old['nodes']))
+        if (old['seconds'] >= min_seconds and
+                result['nodes_per_second'] < old['nodes_per_second'] * (1 - tolerance)):
+            regressions.append('{}: searches {:.0f} nodes/s instead of {:.0f}'.format(
+                name, result['nodes_per_second'], old['nodes_per_second']))
+    return regressions
+
+
+# ______________________________________________________________________________
+# Checks
+
+
+def check_games():
+    """Check that the games can be sent to worker processes, as ParallelSearch,
+    LazySMP and RootParallelMCTS do, that pack and unpack give back the
+    states of random games, and that TicTacToe states built without keys
+    get those of their boards; raise AssertionError if not."""
+    rng = random.Random(0)
+    for game in (ConnectFour(6, 7, 4), TicTacToe()):
+        assert pickle.loads(pickle.dumps(game)).initial == game.initial, game
+        for _ in range(100):
+            state = game.initial
+            while True:
+                assert game.unpack(game.pack(state)) == state, state
+                if game.terminal_test(state):
+                    break
+                state = game.result(state, rng.choice(game.actions(state)))
+    tictactoe = TicTacToe()
+    state = tictactoe.result(tictactoe.result(tictactoe.initial, (1, 2)), (2, 2))
+    bare = GameState(to_move=state.to_move, utility=state.utility, board=state.board,
+                     moves=state.moves)
+    assert tictactoe.canonical(bare) == tictactoe.canonical(state), bare
+    assert tictactoe.result(bare, (3, 3)) == tictactoe.result(state, (3, 3)), bare
+
+
+# The number of positions perft finds 1, 2, 3, ... moves into every game
+PERFT_COUNTS = {
+    "connect4": [7, 49, 343, 2401, 16807, 117649, 823536],
+    "tictactoe": [9, 72, 504, 3024, 15120, 54720, 148176, 200448, 127872],
+    "fig52": [3, 9],
+    "fig52extended": [3, 9, 27],
+    "backgammon": [4935],
+}
+
+
+def perft_games():
+    """Return the games perft counts the positions of, by name."""
+    return {"connect4": ConnectFour(6, 7, 4), "tictactoe": TicTacToe(), "fig52": Fig52Game(),
+            "fig52extended": Fig52Extended(), "backgammon": Backgammon()}
+
+
+def check_perft():
+    """Check that perft finds PERFT_COUNTS positions from the start of every
+    game; raise AssertionError if not."""
+    by_name = perft_games()
+    for name, counts in PERFT_COUNTS.items():
+        game = by_name[name]
+        for depth, count in enumerate(counts, 1):
+            found = perft(game.initial, game, depth)
+            assert found == count, '{} at depth {}: {} positions, not {}'.format(name, depth,
+                                                                                 found, count)
+
+
+def check_search_keys():
+    """Check that a heuristic ConnectFour search scores a position as on a
+    fresh table after its mirror image was searched on the same table;
+    raise AssertionError if not."""
+    game = ConnectFour(6, 7, 4)
+    for columns in ("4453", "3324", "12", "31"):
+        state = game.play_columns(columns)
+        eval_fn = evaluation_for(game.to_move(state))
+        tt = TranspositionTable()
+        principal_variation_search(game.mirror(state), game, 4, eval_fn=eval_fn, tt=tt)
+        shared = principal_variation_search(state, game, 4, eval_fn=eval_fn, tt=tt).score
+        fresh = principal_variation_search(state, game, 4, eval_fn=eval_fn,
+                                           tt=TranspositionTable()).score
+        assert shared == fresh, '{}: {} after the mirror image, not {}'.format(columns, shared,
+                                                                               fresh)
+
+
+# The move the search functions pick in positions reached by playing moves
+# into a game from its start
+MOVE_CHECKS = [
+    ("fig52", [], 'a1'),
+    ("tictactoe", [], (1, 1)),
+    ("tictactoe", [(1, 1), (2, 2), (3, 3)], (1, 2)),
+    ("tictactoe", [(2, 2), (1, 1), (3, 3)], (1, 3)),
+    ("tictactoe", [(1, 1), (2, 2), (1, 2)], (1, 3)),
+    ("tictactoe", [(1, 1), (2, 1), (1, 2), (2, 2)], (1, 3)),
+]
+
+
+def check_moves():
+    """Check that minmax_decision, alpha_beta_search and alpha_beta_cutoff_search
+    pick the moves of MOVE_CHECKS; raise AssertionError if not."""
+    by_name = perft_games()
+    for name, moves, move in MOVE_CHECKS:
+        game = by_name[name]
+        state = game.initial
+        for played in moves:
+            state = game.result(state, played)
+        for search in (minmax_decision, alpha_beta_search, alpha_beta_cutoff_search):
+            found = search(state, game)
+            assert found == move, '{} after {}: {} picks {}, not {}'.format(
+                name, moves, search.__name__, found, move)
 
 
 if __name__ == "__main__":
-    print(FONT)
+    parser = argparse.ArgumentParser(description="Play Connect 4 against the computer, "
+                                                 "with a tutor suggesting your moves.")
+    parser.add_argument("--analyze", metavar="FILE",
+                        help="instead of playing, score the positions in FILE, one per line "
+                             "as the columns played (e.g. 4453)")
+    parser.add_argument("--depth", type=int,
+                        help="with --analyze, also search each position's best move this deep")
+    parser.add_argument("--workers", type=int,
+                        help="with --depth, split each search between this many processes")
+    parser.add_argument("--build-book", type=int, metavar="PLIES",
+                        help="instead of playing, write an opening book of the positions up to "
+                             "PLIES moves in, searched --depth deep (default 8), to "
+                             "$TUTOR_BOOK or connect4.book")
+    parser.add_argument("--solve", metavar="COLUMNS",
+                        help="instead of playing, print the exact score and a best move of the "
+                             "position reached by playing COLUMNS (e.g. 4453)")
+    parser.add_argument("--weak", action="store_true",
+                        help="with --solve, only work out who wins")
+    parser.add_argument("--benchmark", metavar="RESULTS",
+                        help="instead of playing, time the searches of every player on a fixed "
+                             "set of positions, write the results to RESULTS as JSON and report "
+                             "the regressions against $TUTOR_BENCHMARK or benchmark.json")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="with --benchmark, write the results to $TUTOR_BENCHMARK or "
+                             "benchmark.json, for later runs to be compared against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="with --benchmark, the fraction more nodes, or fewer nodes per "
+                             "second, than the baseline that counts as a regression "
+                             "(default 0.25)")
+    parser.add_argument("--perft", type=int, metavar="DEPTH",
+                        help="instead of playing, count the positions DEPTH moves into --game "
+                             "below each first move, and time how fast the moves are generated")
+    parser.add_argument("--game", choices=("connect4", "tictactoe", "fig52", "fig52extended",
+                                           "backgammon"), default="connect4",
+                        help="with --perft, the game to count the positions of (default connect4)")
+    parser.add_argument("--columns", default="",
+                        help="with --perft on Connect 4, start from the position reached by "
+                             "playing COLUMNS (e.g. 4453) instead of the empty board")
+    parser.add_argument("--check", action="store_true",
+                        help="instead of playing, run the regression checks, among them the "
+                             "perft counts of every game")
+    parser.add_argument("--player", choices=("alphabeta", "mtdf", "mcts"),
+                        help="how the computer searches its moves (default: alphabeta, "
+                             "pondering on your time)")
+    args = parser.parse_args()
     test = ConnectFour(6, 7, 4)
-    utility = test.play_test(alpha_beta_cutoff_player)  # computer moves first1
+    if args.check:
+        check_games()
+        check_perft()
+        check_moves()
+        check_search_keys()
+        print("ok")
+        sys.exit()
+    if args.analyze:
+        analyze_file(args.analyze, test, args.depth, workers=args.workers)
+        sys.exit()
+    if args.solve is not None:
+        state = test.play_columns(args.solve)
+        solver = ConnectFourSolver(test)
+        if args.weak or test.terminal_test(state):
+            print(solver.solve(state, weak=args.weak))
+        else:
+            print(*solver.best_move(state), sep='\t')
+        sys.exit()
+    if args.perft is not None:
+        game = perft_games()[args.game]
+        state = game.play_columns(args.columns) if args.game == "connect4" else game.initial
+        start = time.perf_counter()
+        counts = perft_divide(state, game, args.perft)
+        seconds = time.perf_counter() - start
+        for move, count in counts.items():
+            print(move, count, sep='\t')
+        total = sum(counts.values()) if counts else perft(state, game, args.perft)
+        print("total", total, sep='\t')
+        print("{:.3f} s, {:.0f} positions/s".format(seconds, total / seconds if seconds else 0))
+        sys.exit()
+    if args.benchmark:
+        results = run_benchmark()
+        with open(args.benchmark, 'w') as file:
+            json.dump(results, file, indent=1)
+        for result in results:
+            print(result['game'], result['position'], result['player'], result['move'],
+                  result['nodes'], '{:.0f} nodes/s'.format(result['nodes_per_second']), sep='\t')
+        regressions = []
+        if os.path.exists(BENCHMARK_PATH):
+            with open(BENCHMARK_PATH) as file:
+                regressions = compare_benchmark(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        if args.save_baseline:
+            with open(BENCHMARK_PATH, 'w') as file:
+                json.dump(results, file, indent=1)
+        sys.exit(1 if regressions else 0)
+    if args.build_book is not None:
+        count = build_book(test, BOOK_PATH, args.build_book, args.depth or 8)
+        print(count, "positions written to", BOOK_PATH)
+        sys.exit()
+    SCREEN = pygame.display.set_mode(SIZE)
+    print(FONT)
+    # alphabeta is play_test's own search, which ponders on the human's time
+    players = {"alphabeta": None, "mtdf": mtdf_player,
+               "mcts": MCTS(test, time_limit=TIME_BUDGET_MS / 1000, playout=test.playout)}
+    utility = test.play_test(players.get(args.player))  # computer moves first1
     if utility < 0:
         label1 = FONT.render("Player Victory!", 1, YELLOW)
         pygame.draw.rect(SCREEN,BLACK,(0,0,WIDTH,SQUARESIZE))